@@ -1,15 +1,27 @@
 import asyncio
+import base64
 import time
-import PIL
 from google import genai
-from PIL import Image
 from google.genai import types
 import os
+import threading
 from io import BytesIO
 import wave
-import numpy as np
-import pyaudio
-import sounddevice as sd
+import hashlib
+import json
+import concurrent.futures
+import itertools
+import mimetypes
+import random
+import queue
+import re
+import bisect
+import mmap
+import httpx
+from collections import OrderedDict
+
+#PIL, numpy, pyaudio and sounddevice are imported by the classes that use them
+#so text only programs do not pay for them (or need an audio device) at import
 
 """
 Run the following commands in the terminal:
@@ -26,16 +38,162 @@ https://aistudio.google.com/app/apikey
 
 api_key = ""
 
+class lazyComponent():
+    #Builds a geminiAI component the first time it is accessed and then reuses it
+    #factory receives the owning geminiAI so it can inject the shared client
+    def __init__(self, factory):
+        self.factory = factory
+        self.name = None
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        components = instance.__dict__.get("_components")
+        if components is None:
+            #sub components inherit from geminiAI but do not own any components
+            raise AttributeError(self.name)
+        component = components.get(self.name)
+        if component is None:
+            with instance._lock:
+                component = components.get(self.name)
+                if component is None:
+                    component = self.factory(instance)
+                    for name in instance.sharedAttributes:
+                        setattr(component, name, getattr(instance, name))
+                    components[self.name] = component
+        return component
+
 class geminiAI():
-    def __init__(self, Key):
+    #Every component shares one pooled client, music gets its own as Lyria needs v1alpha
+    text = lazyComponent(lambda ai: geminiText(ai.key, client=ai.client))
+    geminImage = lazyComponent(lambda ai: geminiImage(ai.key, client=ai.client))
+    imagen3 = lazyComponent(lambda ai: Imagegen(ai.key, client=ai.client))
+    veo3 = lazyComponent(lambda ai: videoGeneration(ai.key, client=ai.client))
+    singleSpeech = lazyComponent(lambda ai: singleSpeech(ai.key, client=ai.client))
+    multiSpeech = lazyComponent(lambda ai: MultiSpeech(ai.key, client=ai.client))
+    lyria = lazyComponent(lambda ai: music(ai.key, client=ai.getMusicClient()))
+    #components built outside a geminiAI send requests without a guard
+    guard = None
+    output = None
+    preprocessor = None
+    media = None
+    metrics = None
+    #handed to every component the geminiAI builds
+    sharedAttributes = ("guard", "output", "preprocessor", "media", "metrics")
+
+    def __init__(self, Key, httpOptions=None, guard=None):
+        self._lock = threading.RLock()
+        self._components = {}
+        self.guard = guard or requestGuard()
+        self.output = outputWriter("Output")
+        self.media = mediaManager(self)
+        self.metrics = metricsRegistry()
+        self.key = Key
+        self.httpOptions = httpOptions
+        self.recordings = None
+        self.musicClient = None
+        self.client = self.buildClient(Key)
         self.createOutput()
-        self.text = geminiText(Key)
-        self.geminImage = geminiImage(Key)
-        self.imagen3 = Imagegen(Key)
-        self.veo3 = videoGeneration(Key)
-        self.singleSpeech = singleSpeech(Key)
-        self.multiSpeech = MultiSpeech(Key)
-        self.lyria = music(Key)
+
+    def buildClient(self, key, apiVersion=None):
+        #Builds a client, the http options are shared so every client pools connections the same way
+        options = dict(self.__dict__.get("httpOptions") or {})
+        if apiVersion:
+            options["api_version"] = apiVersion
+        if options:
+            return genai.Client(api_key=key, http_options=options)
+        return genai.Client(api_key=key)
+
+    def useRecordings(self, path, mode="replay", timing=0):
+        #Sends every HTTP request through a record / replay store under the shared client
+        #mode="record" calls Google and saves each response, "replay" never calls Google, "auto" records only what is missing
+        #timing=1 replays the recorded latency, 0 replays as fast as possible
+        # i.e. myAI.useRecordings("Recordings", mode="record") once, then myAI.useRecordings("Recordings") for load tests
+        #Lyria uses a websocket and is not recorded
+        store = replayStore(path)
+        options = dict(self.httpOptions or {})
+        storeOptions = store.httpOptions(mode, timing)
+        for name in ("client_args", "async_client_args"):
+            options[name] = {**(options.get(name) or {}), **storeOptions[name]}
+        self.httpOptions = options
+        self.recordings = store
+        self.updateKey(self.key)
+        return store
+
+    def getMusicClient(self):
+        #Lyria realtime is only available on v1alpha so it can not use the shared client
+        with self._lock:
+            if self.musicClient is None:
+                self.musicClient = self.buildClient(self.key, apiVersion="v1alpha")
+            return self.musicClient
+
+    def getComponents(self):
+        #returns the components that have been built so far
+        return dict(self.__dict__.get("_components", {}))
+
+    def share(self, name, value):
+        #sets a shared attribute here and on every component built so far
+        setattr(self, name, value)
+        for component in self.__dict__.get("_components", {}).values():
+            setattr(component, name, value)
+
+    def enableImagePreprocessing(self, maxEdge=1536, format="JPEG", quality=85, maxCacheBytes=256 * 1024 * 1024, diskPath=None):
+        #Downscales and re encodes images before they are uploaded
+        # i.e. myAI.enableImagePreprocessing(maxEdge=1024, format="WEBP", quality=80)
+        self.share("preprocessor", imagePreprocessor(maxEdge, format, quality, maxCacheBytes, diskPath))
+
+    def disableImagePreprocessing(self):
+        #Uploads images at full resolution again
+        self.share("preprocessor", None)
+
+    def loadImage(self, path):
+        #returns a preprocessed image part when preprocessing is enabled, otherwise the PIL image
+        if self.preprocessor:
+            return self.preprocessor.process(path).asPart()
+        from PIL import Image
+        return Image.open(path)
+
+    def loadImages(self, paths):
+        #loads several images, preprocessing them on a thread pool when it is enabled
+        if self.preprocessor:
+            return [prepared.asPart() for prepared in self.preprocessor.processMany(paths)]
+        return [self.loadImage(path) for path in paths]
+
+    def getMedia(self):
+        #returns the media manager, components built on their own get their own
+        if self.media is None:
+            self.media = mediaManager(self)
+        return self.media
+
+    def uploadMedia(self, path, mimeType=None):
+        #Uploads a document, image, audio or video file once and returns a handle for contents
+        # i.e. myAI.text.updateContents([myAI.uploadMedia("report.pdf"), "Summarise this report"])
+        try:
+            return self.getMedia().upload(path, mimeType)
+        except Exception as e:
+            print(f"There was an error: {str(e)}")
+
+    def uploadMediaMany(self, paths, progress=None):
+        #Uploads several files concurrently, returns the handles in the same order
+        try:
+            return self.getMedia().uploadMany(paths, progress)
+        except Exception as e:
+            print(f"There was an error: {str(e)}")
+
+    def getOutput(self):
+        #returns the output writer, components built on their own get a default one
+        if self.output is None:
+            self.output = outputWriter("Output")
+        return self.output
+
+    def flushOutput(self, timeout=None):
+        #waits until every background save has been written
+        if self.output:
+            return self.output.flush(timeout)
+        return True
 
     def createOutput(self):
         #Forcefully creates an output folder
@@ -47,17 +205,2148 @@ class geminiAI():
     
     def updateKey(self, key):
         #Updates the key
-        self.client = genai.Client(api_key=key)
+        if "_components" not in self.__dict__:
+            self.client = self.buildClient(key)
+            return
+        #New clients are built first so the swap under the lock is a plain reassignment
+        client = self.buildClient(key)
+        musicClient = self.buildClient(key, apiVersion="v1alpha") if self.musicClient is not None else None
+        with self._lock:
+            self.key = key
+            self.client = client
+            self.musicClient = musicClient
+            for name, component in self._components.items():
+                component.client = musicClient if name == "lyria" else client
 
     def updateModel(self, newModel):
        if newModel:
           self.model = newModel
 
+    def updateRateLimit(self, model, rpm=None, tpm=None):
+        #Sets the requests and tokens per minute for a model, shared by every component
+        # i.e. myAI.updateRateLimit("gemini-2.0-flash", **defaultRateLimits["gemini-2.0-flash"])
+        if self.guard is None:
+            self.guard = requestGuard()
+        self.guard.limiter.updateLimit(model, rpm, tpm)
+
+    def guarded(self, model, request, tokens=0, payload=None):
+        #Sends request() through the shared rate limiter, retries and circuit breaker and records it in the metrics
+        #payload is only used to measure the request size
+        span = self.metrics.start(type(self).__name__, model, payload) if self.metrics else None
+        if span:
+            request = span.wrap(request)
+        try:
+            response = request() if self.guard is None else self.guard.call(model, request, tokens)
+        except Exception as e:
+            if span:
+                span.fail(e)
+            raise
+        return span.finish(response) if span else response
+
+    async def guardedAsync(self, model, request, tokens=0, payload=None):
+        #async version of guarded
+        span = self.metrics.start(type(self).__name__, model, payload) if self.metrics else None
+        if span:
+            request = span.wrap(request)
+        try:
+            response = await request() if self.guard is None else await self.guard.callAsync(model, request, tokens)
+        except Exception as e:
+            if span:
+                span.fail(e)
+            raise
+        return span.finish(response) if span else response
+
+    def getMetrics(self, format="json"):
+        #returns latency, time to first byte, queue wait, tokens, bytes and errors per component and model
+        #format="json" returns a dict, format="prometheus" returns Prometheus text
+        if self.metrics is None:
+            return None
+        if format == "prometheus":
+            return self.metrics.toPrometheus()
+        return self.metrics.snapshot()
+
+    def addMetricsHook(self, hook):
+        #hook(record) is called with a dict after every call, i.e. to forward it to a log or another metrics system
+        if self.metrics is None:
+            self.share("metrics", metricsRegistry())
+        self.metrics.addHook(hook)
+
+    def enableTracing(self, tracer=None):
+        #Starts an OpenTelemetry span for every call, uses the global tracer provider when no tracer is given
+        # needs pip install opentelemetry-api
+        if tracer is None:
+            from opentelemetry import trace
+            tracer = trace.get_tracer("GeminiAPI")
+        if self.metrics is None:
+            self.share("metrics", metricsRegistry())
+        self.metrics.tracer = tracer
+
+    def disableTracing(self):
+        if self.metrics:
+            self.metrics.tracer = None
+
+class circuitOpenError(Exception):
+    #Raised instead of sending a request while a model's circuit breaker is open
+    pass
+
+class tokenBucket():
+    #Refills at rate units per second up to capacity, the level can go negative to record debt
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.level = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def refill(self):
+        #caller holds the lock
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount):
+        #takes amount from the bucket and returns how long the caller has to wait for it
+        amount = min(amount, self.capacity)
+        with self.lock:
+            self.refill()
+            self.level -= amount
+            if self.level >= 0:
+                return 0.0
+            return -self.level / self.rate
+
+    def consume(self, amount):
+        #records usage without waiting, i.e. when a response used more tokens than estimated
+        with self.lock:
+            self.refill()
+            self.level -= amount
+
+class rateLimiter():
+    #Requests per minute and tokens per minute buckets for each model
+    #models without a limit are not throttled
+    def __init__(self, limits=None):
+        self.limits = {}
+        self.buckets = {}
+        self.lock = threading.Lock()
+        for model, limit in (limits or {}).items():
+            self.updateLimit(model, limit.get("rpm"), limit.get("tpm"))
+
+    def updateLimit(self, model, rpm=None, tpm=None):
+        #sets the quota for a model, None removes that limit
+        with self.lock:
+            self.limits[model] = {"rpm": rpm, "tpm": tpm}
+            self.buckets[model] = {
+                "rpm": tokenBucket(rpm, rpm / 60) if rpm else None,
+                "tpm": tokenBucket(tpm, tpm / 60) if tpm else None,
+            }
+
+    def reserve(self, model, tokens=0):
+        #reserves one request and the estimated tokens, returns the wait in seconds
+        with self.lock:
+            buckets = self.buckets.get(model)
+        if not buckets:
+            return 0.0
+        wait = 0.0
+        if buckets["rpm"]:
+            wait = max(wait, buckets["rpm"].reserve(1))
+        if buckets["tpm"] and tokens:
+            wait = max(wait, buckets["tpm"].reserve(tokens))
+        return wait
+
+    def settle(self, model, estimated, actual):
+        #charges the difference once the real token usage is known
+        with self.lock:
+            buckets = self.buckets.get(model)
+        if buckets and buckets["tpm"] and actual and actual > estimated:
+            buckets["tpm"].consume(actual - estimated)
+
+class circuitBreaker():
+    #Opens after failureThreshold retryable failures in a row and fails fast for resetTimeout seconds
+    #then lets a single trial request through (half open) to decide whether to close again
+    def __init__(self, failureThreshold=5, resetTimeout=30):
+        self.failureThreshold = failureThreshold
+        self.resetTimeout = resetTimeout
+        self.failures = 0
+        self.openedAt = None
+        self.trialRunning = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        #raises circuitOpenError while the breaker is open, returns True when this call is the half open trial
+        with self.lock:
+            if self.openedAt is None:
+                return False
+            if time.monotonic() - self.openedAt < self.resetTimeout or self.trialRunning:
+                raise circuitOpenError("The circuit breaker is open, the backend is failing")
+            self.trialRunning = True
+            return True
+
+    def releaseTrial(self):
+        #lets another trial through when the trial ended without an outcome, i.e. it was cancelled
+        with self.lock:
+            self.trialRunning = False
+
+    def recordSuccess(self):
+        with self.lock:
+            self.failures = 0
+            self.openedAt = None
+            self.trialRunning = False
+
+    def recordFailure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trialRunning or self.failures >= self.failureThreshold:
+                self.openedAt = time.monotonic()
+            self.trialRunning = False
+
+    def getState(self):
+        with self.lock:
+            if self.openedAt is None:
+                return "closed"
+            if self.trialRunning or time.monotonic() - self.openedAt >= self.resetTimeout:
+                return "half open"
+            return "open"
+
+#Quotas can be applied with myAI.updateRateLimit(model, rpm, tpm), these match the free tier
+defaultRateLimits = {
+    "gemini-2.0-flash": {"rpm": 15, "tpm": 1000000},
+    "gemini-2.0-flash-preview-image-generation": {"rpm": 10, "tpm": 200000},
+    "imagen-3.0-generate-002": {"rpm": 10},
+    "veo-2.0-generate-001": {"rpm": 2},
+    "gemini-2.5-flash-preview-tts": {"rpm": 3, "tpm": 10000},
+}
+
+def estimateTokens(contents):
+    #rough input token estimate, about four characters a token and 258 tokens an image
+    if contents is None:
+        return 0
+    if isinstance(contents, str):
+        return len(contents) // 4 + 1
+    if isinstance(contents, (bytes, bytearray)):
+        return len(contents) // 4 + 1
+    if isinstance(contents, (list, tuple)):
+        return sum(estimateTokens(item) for item in contents)
+    if hasattr(contents, "size") and hasattr(contents, "mode"):
+        return 258
+    if hasattr(contents, "text") and isinstance(contents.text, str):
+        return len(contents.text) // 4 + 1
+    if hasattr(contents, "parts") and contents.parts:
+        return estimateTokens(list(contents.parts))
+    return 1
+
+class requestGuard():
+    #Rate limits, retries and circuit breakers shared by every component of a geminiAI
+    retryCodes = {408, 429, 500, 502, 503, 504}
+    transientErrors = {"ConnectError", "ConnectTimeout", "ReadTimeout", "WriteTimeout", "PoolTimeout", "ReadError", "WriteError", "RemoteProtocolError"}
+
+    def __init__(self, limits=None, maxRetries=3, baseDelay=1.0, maxDelay=60.0, failureThreshold=5, resetTimeout=30):
+        self.limiter = rateLimiter(limits)
+        self.maxRetries = maxRetries
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.failureThreshold = failureThreshold
+        self.resetTimeout = resetTimeout
+        self.breakers = {}
+        self.lock = threading.Lock()
+        self.retries = 0
+
+    def getBreaker(self, model):
+        with self.lock:
+            if model not in self.breakers:
+                self.breakers[model] = circuitBreaker(self.failureThreshold, self.resetTimeout)
+            return self.breakers[model]
+
+    def isRetryable(self, error):
+        #server side and network errors are retried, bad requests are not
+        code = getattr(error, "code", None)
+        if isinstance(code, int):
+            return code in self.retryCodes
+        if isinstance(error, (ConnectionError, TimeoutError)):
+            return True
+        return type(error).__name__ in self.transientErrors
+
+    def retryHint(self, error):
+        #returns the delay the server asked for in seconds, if any
+        response = getattr(error, "response", None)
+        headers = getattr(response, "headers", None)
+        if headers:
+            try:
+                return float(headers.get("retry-after"))
+            except (TypeError, ValueError):
+                pass
+        pending = [getattr(error, "details", None)]
+        while pending:
+            value = pending.pop()
+            if isinstance(value, dict):
+                delay = value.get("retryDelay")
+                if isinstance(delay, str) and delay.endswith("s"):
+                    try:
+                        return float(delay[:-1])
+                    except ValueError:
+                        pass
+                pending.extend(value.values())
+            elif isinstance(value, list):
+                pending.extend(value)
+        return None
+
+    def backoff(self, attempt, error):
+        #full jitter exponential backoff, never shorter than the server hint
+        delay = random.uniform(0, min(self.maxDelay, self.baseDelay * 2 ** attempt))
+        hint = self.retryHint(error)
+        if hint is not None:
+            delay = max(delay, min(hint, self.maxDelay))
+        return delay
+
+    def usage(self, response):
+        metadata = getattr(response, "usage_metadata", None)
+        return getattr(metadata, "total_token_count", None) if metadata else None
+
+    def call(self, model, request, tokens=0):
+        #runs request() under the model's limits, retrying retryable errors
+        breaker = self.getBreaker(model)
+        attempt = 0
+        while True:
+            trial = breaker.allow()
+            try:
+                wait = self.limiter.reserve(model, tokens)
+                if wait:
+                    time.sleep(wait)
+                response = request()
+            except Exception as e:
+                trial = False
+                if not self.isRetryable(e):
+                    #the backend answered, a bad request says nothing about its health
+                    breaker.recordSuccess()
+                    raise
+                breaker.recordFailure()
+                if attempt >= self.maxRetries:
+                    raise
+                with self.lock:
+                    self.retries += 1
+                time.sleep(self.backoff(attempt, e))
+                attempt += 1
+                continue
+            else:
+                trial = False
+                breaker.recordSuccess()
+            finally:
+                #a cancelled trial has no outcome, free it so the next call can try
+                if trial:
+                    breaker.releaseTrial()
+            self.limiter.settle(model, tokens, self.usage(response))
+            return response
+
+    async def callAsync(self, model, request, tokens=0):
+        #async version of call, request() returns an awaitable
+        breaker = self.getBreaker(model)
+        attempt = 0
+        while True:
+            trial = breaker.allow()
+            try:
+                wait = self.limiter.reserve(model, tokens)
+                if wait:
+                    await asyncio.sleep(wait)
+                response = await request()
+            except Exception as e:
+                trial = False
+                if not self.isRetryable(e):
+                    #the backend answered, a bad request says nothing about its health
+                    breaker.recordSuccess()
+                    raise
+                breaker.recordFailure()
+                if attempt >= self.maxRetries:
+                    raise
+                with self.lock:
+                    self.retries += 1
+                await asyncio.sleep(self.backoff(attempt, e))
+                attempt += 1
+                continue
+            else:
+                trial = False
+                breaker.recordSuccess()
+            finally:
+                #a cancelled trial has no outcome, free it so the next call can try
+                if trial:
+                    breaker.releaseTrial()
+            self.limiter.settle(model, tokens, self.usage(response))
+            return response
+
+def payloadBytes(value):
+    #rough size of a request payload, text counts its UTF-8 bytes and inline data its raw bytes
+    #an int is taken as a size that is already known, i.e. a file being uploaded
+    if value is None or isinstance(value, bool):
+        return 0
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return len(value)
+    if isinstance(value, (list, tuple)):
+        return sum(payloadBytes(item) for item in value)
+    if isinstance(value, dict):
+        return sum(payloadBytes(item) for item in value.values())
+    if hasattr(value, "size") and hasattr(value, "mode"):
+        #PIL images are counted as raw pixels
+        return value.size[0] * value.size[1] * len(value.getbands())
+    inline = getattr(value, "inline_data", None)
+    if inline is not None:
+        return len(inline.data or b"")
+    parts = getattr(value, "parts", None)
+    if parts:
+        return payloadBytes(list(parts))
+    text = getattr(value, "text", None)
+    if isinstance(text, str):
+        return len(text.encode("utf-8"))
+    data = getattr(value, "image_bytes", None) or getattr(value, "video_bytes", None)
+    return len(data) if data else 0
+
+def responseBytes(response):
+    #size of the text, audio, image and video data in a response
+    if isinstance(response, (bytes, bytearray)):
+        return len(response)
+    total = 0
+    for candidate in getattr(response, "candidates", None) or []:
+        content = getattr(candidate, "content", None)
+        total += payloadBytes(list(getattr(content, "parts", None) or []))
+    for generated in getattr(response, "generated_images", None) or []:
+        total += payloadBytes(getattr(generated, "image", None))
+    return total
+
+class latencyHistogram():
+    #Bucketed histogram of seconds, percentiles are interpolated inside the bucket they fall in
+    #callers hold the registry lock
+    bounds = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.bounds[index - 1] if index else 0.0
+                upper = self.bounds[index] if index < len(self.bounds) else self.max
+                return min(self.max, lower + (upper - lower) * (rank - seen) / count)
+            seen += count
+        return self.max
+
+    def cumulative(self):
+        #yields (upper bound, calls at or under it) the way Prometheus expects
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            yield bound, seen
+        yield float("inf"), self.count
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "max": self.max,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "p99": self.percentile(0.99),
+        }
+
+class callSpan():
+    #One outbound call, started by metricsRegistry.start and finished through guarded
+    #queue wait is the time before the first attempt (rate limiter and breaker), latency runs from the first attempt
+    def __init__(self, registry, component, model, payload=None):
+        self.registry = registry
+        self.component = component
+        self.model = model
+        self.started = time.perf_counter()
+        self.attemptStarted = None
+        self.firstByte = None
+        self.attempts = 0
+        self.requestBytes = payloadBytes(payload)
+        self.responseBytes = 0
+        self.inputTokens = 0
+        self.outputTokens = 0
+        self.error = None
+        self.recorded = False
+        self.trace = registry.startTrace(self)
+
+    def wrap(self, request):
+        #counts attempts, works for sync requests and ones that return an awaitable
+        def attempt():
+            self.beginAttempt()
+            return request()
+        return attempt
+
+    def beginAttempt(self):
+        if self.attemptStarted is None:
+            self.attemptStarted = time.perf_counter()
+        self.attempts += 1
+
+    def observe(self, response):
+        #adds a response or stream chunk
+        if self.firstByte is None:
+            self.firstByte = time.perf_counter()
+        self.responseBytes += responseBytes(response)
+        metadata = getattr(response, "usage_metadata", None)
+        if metadata:
+            self.inputTokens = getattr(metadata, "prompt_token_count", None) or self.inputTokens
+            self.outputTokens = getattr(metadata, "candidates_token_count", None) or self.outputTokens
+
+    def observeBytes(self, count):
+        #for raw streams such as Lyria audio
+        if self.firstByte is None:
+            self.firstByte = time.perf_counter()
+        self.responseBytes += count
+
+    def finish(self, response=None):
+        #streams are recorded once they are exhausted (or abandoned), everything else straight away
+        if hasattr(response, "__next__"):
+            return self.wrapStream(response)
+        if hasattr(response, "__anext__"):
+            return self.wrapStreamAsync(response)
+        if response is not None:
+            self.observe(response)
+        self.registry.record(self)
+        return response
+
+    def fail(self, error):
+        self.error = error
+        self.registry.record(self)
+
+    def wrapStream(self, stream):
+        try:
+            for chunk in stream:
+                self.observe(chunk)
+                yield chunk
+        except GeneratorExit:
+            self.registry.record(self)
+            raise
+        except Exception as e:
+            self.fail(e)
+            raise
+        self.registry.record(self)
+
+    async def wrapStreamAsync(self, stream):
+        try:
+            async for chunk in stream:
+                self.observe(chunk)
+                yield chunk
+        except GeneratorExit:
+            self.registry.record(self)
+            raise
+        except Exception as e:
+            self.fail(e)
+            raise
+        self.registry.record(self)
+
+class metricsRegistry():
+    #Latency, time to first byte and queue wait histograms, tokens, bytes, retries and errors
+    #for every outbound call, grouped by component and model
+    #hooks are called with a dict for every finished call, tracer is an optional OpenTelemetry tracer
+    def __init__(self, tracer=None):
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.hooks = []
+        self.tracer = tracer
+        self.inFlight = 0
+
+    def start(self, component, model, payload=None):
+        #returns a span for a call that is about to be sent
+        with self.lock:
+            self.inFlight += 1
+        return callSpan(self, component, model, payload)
+
+    def addHook(self, hook):
+        #hook(record) runs on the calling thread after every call, keep it cheap
+        self.hooks.append(hook)
+
+    def removeHook(self, hook):
+        if hook in self.hooks:
+            self.hooks.remove(hook)
+
+    def newStats(self):
+        return {
+            "calls": 0,
+            "errors": {},
+            "retries": 0,
+            "inputTokens": 0,
+            "outputTokens": 0,
+            "requestBytes": 0,
+            "responseBytes": 0,
+            "latency": latencyHistogram(),
+            "ttfb": latencyHistogram(),
+            "queueWait": latencyHistogram(),
+        }
+
+    def record(self, span):
+        #adds a finished span, a span is only ever counted once
+        end = time.perf_counter()
+        attemptStarted = span.attemptStarted or end
+        error = span.error
+        record = {
+            "component": span.component,
+            "model": span.model,
+            "latency": end - attemptStarted,
+            "ttfb": (span.firstByte or end) - attemptStarted,
+            "queueWait": attemptStarted - span.started,
+            "retries": max(0, span.attempts - 1),
+            "inputTokens": span.inputTokens,
+            "outputTokens": span.outputTokens,
+            "requestBytes": span.requestBytes,
+            "responseBytes": span.responseBytes,
+            "error": type(error).__name__ if error is not None else None,
+            "errorCode": getattr(error, "code", None),
+        }
+        with self.lock:
+            if span.recorded:
+                return None
+            span.recorded = True
+            self.inFlight -= 1
+            key = (span.component, span.model)
+            stats = self.stats.get(key)
+            if stats is None:
+                stats = self.stats[key] = self.newStats()
+            stats["calls"] += 1
+            if record["error"]:
+                stats["errors"][record["error"]] = stats["errors"].get(record["error"], 0) + 1
+            for name in ("retries", "inputTokens", "outputTokens", "requestBytes", "responseBytes"):
+                stats[name] += record[name]
+            for name in ("latency", "ttfb", "queueWait"):
+                stats[name].observe(record[name])
+        if span.trace is not None:
+            self.endTrace(span, record)
+        for hook in list(self.hooks):
+            try:
+                hook(record)
+            except Exception as e:
+                print(f"There was an error: {str(e)}")
+        return record
+
+    def startTrace(self, span):
+        if self.tracer is None:
+            return None
+        return self.tracer.start_span(f"gemini.{span.component}", attributes={"gen_ai.system": "gemini", "gen_ai.request.model": span.model})
+
+    def endTrace(self, span, record):
+        trace = span.trace
+        trace.set_attribute("gen_ai.usage.input_tokens", record["inputTokens"])
+        trace.set_attribute("gen_ai.usage.output_tokens", record["outputTokens"])
+        trace.set_attribute("gemini.retries", record["retries"])
+        trace.set_attribute("gemini.queue_wait", record["queueWait"])
+        trace.set_attribute("gemini.ttfb", record["ttfb"])
+        if span.error is not None:
+            from opentelemetry.trace import Status, StatusCode
+            trace.record_exception(span.error)
+            trace.set_status(Status(StatusCode.ERROR, record["error"]))
+        trace.end()
+
+    def snapshot(self):
+        #returns every counter and histogram summary as plain JSON values
+        with self.lock:
+            calls = []
+            for (component, model), stats in sorted(self.stats.items()):
+                entry = {"component": component, "model": model}
+                for name, value in stats.items():
+                    entry[name] = value.snapshot() if isinstance(value, latencyHistogram) else (dict(value) if isinstance(value, dict) else value)
+                calls.append(entry)
+            return {"inFlight": self.inFlight, "calls": calls}
+
+    def toJson(self):
+        return json.dumps(self.snapshot(), indent=2)
+
+    def toPrometheus(self):
+        #returns the counters and histograms in the Prometheus text format
+        lines = [
+            "# TYPE gemini_requests_in_flight gauge",
+            f"gemini_requests_in_flight {self.inFlight}",
+        ]
+        counters = [
+            ("gemini_requests_total", "calls", None),
+            ("gemini_retries_total", "retries", None),
+            ("gemini_tokens_total", "inputTokens", 'direction="input"'),
+            ("gemini_tokens_total", "outputTokens", 'direction="output"'),
+            ("gemini_bytes_total", "requestBytes", 'direction="request"'),
+            ("gemini_bytes_total", "responseBytes", 'direction="response"'),
+        ]
+        histograms = [
+            ("gemini_request_latency_seconds", "latency"),
+            ("gemini_time_to_first_byte_seconds", "ttfb"),
+            ("gemini_queue_wait_seconds", "queueWait"),
+        ]
+        with self.lock:
+            items = sorted(self.stats.items())
+            typed = set()
+            for metric, name, extra in counters:
+                if metric not in typed:
+                    lines.append(f"# TYPE {metric} counter")
+                    typed.add(metric)
+                for (component, model), stats in items:
+                    labels = f'component="{component}",model="{model}"' + (f",{extra}" if extra else "")
+                    lines.append(f"{metric}{{{labels}}} {stats[name]}")
+            lines.append("# TYPE gemini_errors_total counter")
+            for (component, model), stats in items:
+                for error, count in sorted(stats["errors"].items()):
+                    lines.append(f'gemini_errors_total{{component="{component}",model="{model}",error="{error}"}} {count}')
+            for metric, name in histograms:
+                lines.append(f"# TYPE {metric} histogram")
+                for (component, model), stats in items:
+                    labels = f'component="{component}",model="{model}"'
+                    histogram = stats[name]
+                    for bound, count in histogram.cumulative():
+                        le = "+Inf" if bound == float("inf") else repr(float(bound))
+                        lines.append(f'{metric}_bucket{{{labels},le="{le}"}} {count}')
+                    lines.append(f"{metric}_sum{{{labels}}} {histogram.sum}")
+                    lines.append(f"{metric}_count{{{labels}}} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        with self.lock:
+            self.stats.clear()
+
+class replayMissError(Exception):
+    #Raised in replay mode when a request was never recorded
+    pass
+
+class replayStore():
+    #Recorded request / response pairs on disk, indexed by a hash of the request
+    #payloads.bin holds the raw response bodies back to back and is memory mapped for replay,
+    #index.jsonl has one line per response (offset, chunk sizes, status, headers and timing) and is loaded into memory
+    #A request recorded several times (i.e. polling an operation) replays its responses in order, then repeats the last one
+    skippedHeaders = {"transfer-encoding", "connection", "date"}
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.payloadPath = os.path.join(path, "payloads.bin")
+        self.indexPath = os.path.join(path, "index.jsonl")
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.cursors = {}
+        self.map = None
+        self.mapped = 0
+        self.hits = 0
+        self.misses = 0
+        self.recorded = 0
+        if os.path.exists(self.indexPath):
+            with open(self.indexPath) as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.entries.setdefault(entry["key"], []).append(entry)
+        self.payloadFile = open(self.payloadPath, "ab")
+        self.indexFile = open(self.indexPath, "a")
+
+    def makeKey(self, request):
+        #method, path, query (without the API key) and the raw body, headers are ignored
+        query = sorted((name, value) for name, value in request.url.params.multi_items() if name != "key")
+        digest = hashlib.sha256(f"{request.method} {request.url.path} {query}".encode())
+        digest.update(request.content)
+        return digest.hexdigest()
+
+    def lookup(self, key):
+        #returns the next recorded entry for key or None
+        with self.lock:
+            entries = self.entries.get(key)
+            if not entries:
+                self.misses += 1
+                return None
+            cursor = self.cursors.get(key, 0)
+            self.cursors[key] = cursor + 1
+            self.hits += 1
+            return entries[min(cursor, len(entries) - 1)]
+
+    def read(self, entry):
+        #returns the recorded chunks as bytes, sliced from the memory map
+        end = entry["offset"] + sum(entry["chunks"])
+        if end > self.mapped:
+            self.remap(end)
+        chunks = []
+        position = entry["offset"]
+        for size in entry["chunks"]:
+            chunks.append(self.map[position:position + size])
+            position += size
+        return chunks
+
+    def remap(self, end):
+        with self.lock:
+            if end <= self.mapped:
+                return
+            self.payloadFile.flush()
+            #the old map is left to the garbage collector as other threads may still be slicing it
+            with open(self.payloadPath, "rb") as f:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.mapped = len(self.map)
+
+    def record(self, key, request, response, chunks, firstByte, gaps):
+        #appends one response, the payload is flushed before the index line that points at it
+        #rate limits and server errors are not kept so auto mode retries them next time
+        if response.status_code in requestGuard.retryCodes:
+            return
+        headers = [[name, value] for name, value in response.headers.multi_items() if name.lower() not in self.skippedHeaders]
+        with self.lock:
+            offset = self.payloadFile.tell()
+            for chunk in chunks:
+                self.payloadFile.write(chunk)
+            self.payloadFile.flush()
+            entry = {
+                "key": key,
+                "method": request.method,
+                "path": request.url.path,
+                "status": response.status_code,
+                "headers": headers,
+                "offset": offset,
+                "chunks": [len(chunk) for chunk in chunks],
+                "firstByte": firstByte,
+                "gaps": gaps,
+            }
+            self.indexFile.write(json.dumps(entry, separators=(",", ":")) + "\n")
+            self.indexFile.flush()
+            self.entries.setdefault(key, []).append(entry)
+            self.recorded += 1
+
+    def rewind(self):
+        #replays every sequence from its first response again
+        with self.lock:
+            self.cursors.clear()
+
+    def getStats(self):
+        with self.lock:
+            return {
+                "requests": len(self.entries),
+                "responses": sum(len(entries) for entries in self.entries.values()),
+                "hits": self.hits,
+                "misses": self.misses,
+                "recorded": self.recorded,
+                "payloadBytes": self.payloadFile.tell(),
+            }
+
+    def httpOptions(self, mode="replay", timing=0):
+        #http_options for genai.Client, i.e. genai.Client(api_key=key, http_options=store.httpOptions("record"))
+        return {
+            "client_args": {"transport": replayTransport(self, mode, timing)},
+            "async_client_args": {"transport": replayTransportAsync(self, mode, timing)},
+        }
+
+    def close(self):
+        with self.lock:
+            self.payloadFile.close()
+            self.indexFile.close()
+            if self.map is not None:
+                self.map.close()
+                self.map = None
+                self.mapped = 0
+
+class replayTransport(httpx.BaseTransport):
+    #httpx transport for the shared genai.Client
+    #mode="record" sends every request and records the response, "replay" only serves recordings,
+    #"auto" replays what has been recorded and records the rest
+    #timing replays the recorded time to first byte and gaps between stream chunks, scaled by timing (1 is real time)
+    def __init__(self, store, mode="replay", timing=0, inner=None):
+        if mode not in ("record", "replay", "auto"):
+            raise ValueError(f"Unknown mode {mode}")
+        self.store = store
+        self.mode = mode
+        self.timing = timing
+        self.inner = inner
+
+    def handle_request(self, request):
+        request.read()
+        key = self.store.makeKey(request)
+        entry = self.store.lookup(key) if self.mode != "record" else None
+        if entry is not None:
+            if self.timing and entry["firstByte"]:
+                time.sleep(entry["firstByte"] * self.timing)
+            return httpx.Response(entry["status"], headers=entry["headers"], stream=replayStream(self.store.read(entry), entry["gaps"], self.timing))
+        if self.mode == "replay":
+            raise replayMissError(f"No recording for {request.method} {request.url.path}")
+        if self.inner is None:
+            self.inner = httpx.HTTPTransport()
+        started = time.perf_counter()
+        response = self.inner.handle_request(request)
+        return httpx.Response(response.status_code, headers=response.headers, stream=recordingStream(self.store, key, request, response, started))
+
+    def close(self):
+        if self.inner is not None:
+            self.inner.close()
+
+class replayTransportAsync(httpx.AsyncBaseTransport):
+    #async version of replayTransport
+    def __init__(self, store, mode="replay", timing=0, inner=None):
+        if mode not in ("record", "replay", "auto"):
+            raise ValueError(f"Unknown mode {mode}")
+        self.store = store
+        self.mode = mode
+        self.timing = timing
+        self.inner = inner
+
+    async def handle_async_request(self, request):
+        await request.aread()
+        key = self.store.makeKey(request)
+        entry = self.store.lookup(key) if self.mode != "record" else None
+        if entry is not None:
+            if self.timing and entry["firstByte"]:
+                await asyncio.sleep(entry["firstByte"] * self.timing)
+            return httpx.Response(entry["status"], headers=entry["headers"], stream=replayStreamAsync(self.store.read(entry), entry["gaps"], self.timing))
+        if self.mode == "replay":
+            raise replayMissError(f"No recording for {request.method} {request.url.path}")
+        if self.inner is None:
+            self.inner = httpx.AsyncHTTPTransport()
+        started = time.perf_counter()
+        response = await self.inner.handle_async_request(request)
+        return httpx.Response(response.status_code, headers=response.headers, stream=recordingStreamAsync(self.store, key, request, response, started))
+
+    async def aclose(self):
+        if self.inner is not None:
+            await self.inner.aclose()
+
+class replayStream(httpx.SyncByteStream):
+    #yields recorded chunks, waiting the recorded gap between them when timing is set
+    def __init__(self, chunks, gaps, timing=0):
+        self.chunks = chunks
+        self.gaps = gaps
+        self.timing = timing
+
+    def __iter__(self):
+        for index, chunk in enumerate(self.chunks):
+            if index and self.timing:
+                time.sleep(self.gaps[index - 1] * self.timing)
+            yield chunk
+
+class replayStreamAsync(httpx.AsyncByteStream):
+    def __init__(self, chunks, gaps, timing=0):
+        self.chunks = chunks
+        self.gaps = gaps
+        self.timing = timing
+
+    async def __aiter__(self):
+        for index, chunk in enumerate(self.chunks):
+            if index and self.timing:
+                await asyncio.sleep(self.gaps[index - 1] * self.timing)
+            yield chunk
+
+class recordingStream(httpx.SyncByteStream):
+    #passes the live response through as it arrives and records it once it has been read to the end
+    def __init__(self, store, key, request, response, started):
+        self.store = store
+        self.key = key
+        self.request = request
+        self.response = response
+        self.started = started
+
+    def __iter__(self):
+        chunks = []
+        gaps = []
+        firstByte = None
+        last = None
+        for chunk in self.response.stream:
+            now = time.perf_counter()
+            if firstByte is None:
+                firstByte = now - self.started
+            else:
+                gaps.append(now - last)
+            last = now
+            chunks.append(chunk)
+            yield chunk
+        self.store.record(self.key, self.request, self.response, chunks, firstByte or time.perf_counter() - self.started, gaps)
+
+    def close(self):
+        self.response.close()
+
+class recordingStreamAsync(httpx.AsyncByteStream):
+    def __init__(self, store, key, request, response, started):
+        self.store = store
+        self.key = key
+        self.request = request
+        self.response = response
+        self.started = started
+
+    async def __aiter__(self):
+        chunks = []
+        gaps = []
+        firstByte = None
+        last = None
+        async for chunk in self.response.stream:
+            now = time.perf_counter()
+            if firstByte is None:
+                firstByte = now - self.started
+            else:
+                gaps.append(now - last)
+            last = now
+            chunks.append(chunk)
+            yield chunk
+        self.store.record(self.key, self.request, self.response, chunks, firstByte or time.perf_counter() - self.started, gaps)
+
+    async def aclose(self):
+        await self.response.aclose()
+
+class outputWriter():
+    #Saves generated files without listing the output folder
+    #Names come from a per process counter, or the content hash when naming="hash",
+    #and files are sharded into sub folders of shardSize files (or by hash prefix)
+    #Every file is written to a temp file and renamed into place on a background writer pool
+    imageFormats = {".jpg": "JPEG", ".jpeg": "JPEG", ".png": "PNG", ".webp": "WEBP"}
+
+    def __init__(self, root="Output", naming="counter", shardSize=1000, maxWorkers=4, background=True):
+        self.root = root
+        self.naming = naming
+        self.shardSize = shardSize
+        self.maxWorkers = maxWorkers
+        self.background = background
+        #the run id keeps counter names unique across processes sharing the folder
+        self.runId = f"{int(time.time() * 1000):x}{os.getpid():x}"
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.folders = set()
+        self.executor = None
+
+    def makeFolder(self, folder):
+        if folder not in self.folders:
+            os.makedirs(folder, exist_ok=True)
+            self.folders.add(folder)
+
+    def reservePath(self, prefix, ext, data=None):
+        #returns a new unique path, O(1) regardless of how many files are already saved
+        if self.naming == "hash" and data is not None:
+            digest = hashlib.sha256(data).hexdigest()
+            folder = os.path.join(self.root, digest[:2])
+            name = f"{prefix}_{digest[:32]}{ext}"
+        else:
+            number = next(self.counter)
+            folder = os.path.join(self.root, f"{number // self.shardSize:04d}")
+            name = f"{prefix}_{self.runId}_{number}{ext}"
+        self.makeFolder(folder)
+        return os.path.join(folder, name)
+
+    def writeAtomic(self, path, data):
+        #writes next to the final path then renames so readers never see a partial file
+        temp = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp, "wb") as f:
+                f.write(data)
+            os.replace(temp, path)
+        except BaseException:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+        return path
+
+    def submit(self, task):
+        #runs task on the writer pool and returns a future for its result
+        if not self.background:
+            future = concurrent.futures.Future()
+            try:
+                future.set_result(task())
+            except Exception as e:
+                future.set_exception(e)
+            return future
+        with self.lock:
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(self.maxWorkers, thread_name_prefix="output-writer")
+            future = self.executor.submit(task)
+            self.pending.add(future)
+        future.add_done_callback(self.finished)
+        return future
+
+    def finished(self, future):
+        with self.lock:
+            self.pending.discard(future)
+        if future.exception():
+            print(f"There was an error: {str(future.exception())}")
+
+    def saveBytes(self, data, prefix, ext):
+        #saves the bytes as they are, returns a future for the path
+        if self.naming == "hash":
+            return self.submit(lambda: self.writeAtomic(self.reservePath(prefix, ext, data), data))
+        path = self.reservePath(prefix, ext)
+        return self.submit(lambda: self.writeAtomic(path, data))
+
+    def saveDownload(self, download, prefix, ext):
+        #runs download() on the writer pool and saves the bytes it returns, so slow downloads never block the caller
+        path = None if self.naming == "hash" else self.reservePath(prefix, ext)
+        def task():
+            data = download()
+            return self.writeAtomic(path or self.reservePath(prefix, ext, data), data)
+        return self.submit(task)
+
+    def encodeImage(self, image, ext):
+        format = self.imageFormats.get(ext.lower(), "PNG")
+        if format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        buffer = BytesIO()
+        image.save(buffer, format=format)
+        return buffer.getvalue()
+
+    def saveImage(self, image, prefix, ext=".jpg"):
+        #encodes a PIL image on the writer pool and saves it
+        path = None if self.naming == "hash" else self.reservePath(prefix, ext)
+        def task():
+            data = self.encodeImage(image, ext)
+            return self.writeAtomic(path or self.reservePath(prefix, ext, data), data)
+        return self.submit(task)
+
+    def saveImageBytes(self, data, prefix, ext=".jpg"):
+        #decodes and re encodes image bytes on the writer pool and saves them
+        from PIL import Image
+        path = None if self.naming == "hash" else self.reservePath(prefix, ext)
+        def task():
+            encoded = self.encodeImage(Image.open(BytesIO(data)), ext)
+            return self.writeAtomic(path or self.reservePath(prefix, ext, encoded), encoded)
+        return self.submit(task)
+
+    def saveGeneratedImage(self, data, mimeType, prefix, format=None, thumbnailSize=None):
+        #saves generated image bytes and optionally a JPEG thumbnail, returns a future for (path, thumbnail path)
+        #the bytes are written untouched unless format asks for a different encoding
+        #the image is decoded at most once, for the transcode and the thumbnail together
+        sourceExt = mimetypes.guess_extension(mimeType or "") or ".png"
+        sourceExt = ".jpg" if sourceExt in (".jpe", ".jpeg") else sourceExt
+        ext = format or sourceExt
+        def task():
+            image = None
+            if ext != sourceExt or thumbnailSize:
+                from PIL import Image
+                image = Image.open(BytesIO(data))
+                image.load()
+            encoded = data if ext == sourceExt else self.encodeImage(image, ext)
+            path = self.writeAtomic(self.reservePath(prefix, ext, encoded), encoded)
+            thumbnail = None
+            if thumbnailSize:
+                small = image.copy()
+                small.thumbnail(thumbnailSize)
+                encodedSmall = self.encodeImage(small, ".jpg")
+                thumbnail = self.writeAtomic(self.reservePath(f"{prefix}_thumb", ".jpg", encodedSmall), encodedSmall)
+            return path, thumbnail
+        return self.submit(task)
+
+    def saveWave(self, pcm, channels, sampleWidth, rate, prefix):
+        #wraps raw PCM in a WAV header and saves it
+        path = None if self.naming == "hash" else self.reservePath(prefix, ".wav")
+        def task():
+            buffer = BytesIO()
+            with wave.open(buffer, "wb") as wf:
+                wf.setnchannels(channels)
+                wf.setsampwidth(sampleWidth)
+                wf.setframerate(rate)
+                wf.writeframes(pcm)
+            data = buffer.getvalue()
+            return self.writeAtomic(path or self.reservePath(prefix, ".wav", data), data)
+        return self.submit(task)
+
+    def flush(self, timeout=None):
+        #waits for every pending save, returns False if the timeout ran out first
+        with self.lock:
+            pending = list(self.pending)
+        done, notDone = concurrent.futures.wait(pending, timeout)
+        return not notDone
+
+    def close(self):
+        #finishes pending saves and stops the writer pool
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor:
+            executor.shutdown(wait=True)
+
+class preparedImage():
+    #Encoded image bytes ready to upload
+    def __init__(self, data, mimeType, size):
+        self.data = data
+        self.mimeType = mimeType
+        self.size = size
+
+    def asPart(self):
+        #for generate_content contents
+        return types.Part.from_bytes(data=self.data, mime_type=self.mimeType)
+
+    def asImage(self):
+        #for generate_videos
+        return types.Image(image_bytes=self.data, mime_type=self.mimeType)
+
+class imagePreprocessor():
+    #Downscales images to maxEdge pixels and re encodes them as JPEG or WebP before they are uploaded
+    #Results are cached by file path, modification time and size (plus the settings) so unchanged files
+    #are never decoded twice, diskPath keeps the encoded files between runs with their size in a JSON sidecar
+    mimeTypes = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+    extensions = {"JPEG": ".jpg", "WEBP": ".webp", "PNG": ".png"}
+
+    def __init__(self, maxEdge=1536, format="JPEG", quality=85, maxCacheBytes=256 * 1024 * 1024, diskPath=None, maxWorkers=4):
+        self.maxEdge = maxEdge
+        self.format = format.upper()
+        self.quality = quality
+        self.maxCacheBytes = maxCacheBytes
+        self.diskPath = diskPath
+        self.maxWorkers = maxWorkers
+        self.cache = OrderedDict()
+        self.cacheBytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if diskPath:
+            os.makedirs(diskPath, exist_ok=True)
+
+    def cacheKey(self, path):
+        stat = os.stat(path)
+        return hashRequest(os.path.abspath(path), stat.st_mtime_ns, stat.st_size, self.maxEdge, self.format, self.quality)
+
+    def cacheGet(self, key):
+        with self.lock:
+            prepared = self.cache.get(key)
+            if prepared is not None:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return prepared
+        if self.diskPath:
+            try:
+                #the sidecar is written last, so a missing one means the image was never fully saved
+                with open(os.path.join(self.diskPath, f"{key}.json"), encoding="utf-8") as f:
+                    size = json.load(f)
+                with open(os.path.join(self.diskPath, key + self.extensions[self.format]), "rb") as f:
+                    data = f.read()
+                prepared = preparedImage(data, self.mimeTypes[self.format], (size["width"], size["height"]))
+                self.cachePut(key, prepared, False)
+                with self.lock:
+                    self.hits += 1
+                return prepared
+            except (OSError, ValueError, KeyError, TypeError):
+                pass
+        with self.lock:
+            self.misses += 1
+
+    def cachePut(self, key, prepared, toDisk=True):
+        with self.lock:
+            if key not in self.cache:
+                self.cacheBytes += len(prepared.data)
+            self.cache[key] = prepared
+            self.cache.move_to_end(key)
+            while self.cacheBytes > self.maxCacheBytes and len(self.cache) > 1:
+                _, old = self.cache.popitem(last=False)
+                self.cacheBytes -= len(old.data)
+        if toDisk and self.diskPath:
+            path = os.path.join(self.diskPath, key)
+            size = json.dumps({"width": prepared.size[0], "height": prepared.size[1]}).encode("utf-8")
+            try:
+                for target, data in ((path + self.extensions[self.format], prepared.data), (f"{path}.json", size)):
+                    temp = f"{target}.{threading.get_ident()}.tmp"
+                    with open(temp, "wb") as f:
+                        f.write(data)
+                    os.replace(temp, target)
+            except OSError as e:
+                print(f"There was an error: {str(e)}")
+
+    def encode(self, image, source=None):
+        #resizes and re encodes an open PIL image
+        from PIL import Image, ImageOps
+        upright = image.getexif().get(0x0112, 1) == 1
+        if source is not None and upright and image.format == self.format and max(image.size) <= self.maxEdge:
+            #already small enough and in the right format, the original bytes are sent as they are
+            with open(source, "rb") as f:
+                return preparedImage(f.read(), self.mimeTypes[self.format], image.size)
+        if image.format == "JPEG":
+            #lets libjpeg decode at a reduced scale instead of decoding every pixel
+            image.draft("RGB", (self.maxEdge, self.maxEdge))
+        image = ImageOps.exif_transpose(image)
+        if max(image.size) > self.maxEdge:
+            image.thumbnail((self.maxEdge, self.maxEdge), Image.LANCZOS)
+        if self.format == "JPEG" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        buffer = BytesIO()
+        options = {"quality": self.quality} if self.format in ("JPEG", "WEBP") else {}
+        image.save(buffer, format=self.format, **options)
+        return preparedImage(buffer.getvalue(), self.mimeTypes[self.format], image.size)
+
+    def process(self, source):
+        #returns a preparedImage for a file path or a PIL image
+        if not isinstance(source, (str, os.PathLike)):
+            return self.encode(source)
+        key = self.cacheKey(source)
+        prepared = self.cacheGet(key)
+        if prepared is None:
+            from PIL import Image
+            with Image.open(source) as image:
+                prepared = self.encode(image, source)
+            self.cachePut(key, prepared)
+        return prepared
+
+    def processMany(self, sources):
+        #processes several images on a thread pool, results are in the same order
+        sources = list(sources)
+        if len(sources) < 2:
+            return [self.process(source) for source in sources]
+        with concurrent.futures.ThreadPoolExecutor(min(self.maxWorkers, len(sources))) as pool:
+            return list(pool.map(self.process, sources))
+
+    def getStats(self):
+        #returns the cache hit / miss counters
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self.cache), "cacheBytes": self.cacheBytes}
+
+class mediaHandle():
+    #A file uploaded through the Files API, can be put in contents in place of the file itself
+    def __init__(self, name, uri, mimeType, expiresAt, sha256):
+        self.name = name
+        self.uri = uri
+        self.mimeType = mimeType
+        self.expiresAt = expiresAt
+        self.sha256 = sha256
+
+    def asPart(self):
+        return types.Part.from_uri(file_uri=self.uri, mime_type=self.mimeType)
+
+class mediaManager():
+    #Uploads local files once through client.files and remembers them by SHA-256
+    #The index of hash to remote file is kept in indexPath so later runs reuse the uploads
+    #Entries within refreshMargin seconds of expiring are uploaded again
+    def __init__(self, owner, indexPath="Output/mediaIndex.json", refreshMargin=3600, maxWorkers=4, activeTimeout=600):
+        self.owner = owner
+        self.indexPath = indexPath
+        self.refreshMargin = refreshMargin
+        self.maxWorkers = maxWorkers
+        self.activeTimeout = activeTimeout
+        self.index = None
+        self.lock = threading.Lock()
+        self.uploading = {}
+        self.uploads = 0
+        self.reused = 0
+
+    def loadIndex(self):
+        #caller holds the lock
+        if self.index is None:
+            self.index = {}
+            try:
+                with open(self.indexPath, "r", encoding="utf-8") as f:
+                    self.index = json.load(f)
+            except FileNotFoundError:
+                pass
+            except Exception as e:
+                print(f"There was an error: {str(e)}")
+        return self.index
+
+    def saveIndex(self):
+        #caller holds the lock
+        folder = os.path.dirname(self.indexPath)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        temp = f"{self.indexPath}.{threading.get_ident()}.tmp"
+        with open(temp, "w", encoding="utf-8") as f:
+            json.dump(self.index, f)
+        os.replace(temp, self.indexPath)
+
+    def hashFile(self, path):
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def waitUntilActive(self, remote):
+        #videos and large documents are processed before they can be used
+        deadline = time.monotonic() + self.activeTimeout
+        interval = 1
+        while str(getattr(remote, "state", "ACTIVE")).endswith("PROCESSING"):
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"{remote.name} is still processing")
+            time.sleep(interval)
+            interval = min(interval * 1.5, 10)
+            owner = self.owner
+            remote = owner.guarded("files", lambda: owner.client.files.get(name=remote.name))
+        if str(getattr(remote, "state", "ACTIVE")).endswith("FAILED"):
+            raise RuntimeError(f"{remote.name} failed to process")
+        return remote
+
+    def upload(self, path, mimeType=None):
+        #returns a mediaHandle for path, only uploading it if this content is not already uploaded
+        sha256 = self.hashFile(path)
+        while True:
+            with self.lock:
+                entry = self.loadIndex().get(sha256)
+                if entry and entry["expiresAt"] - self.refreshMargin > time.time():
+                    self.reused += 1
+                    return mediaHandle(entry["name"], entry["uri"], entry["mimeType"], entry["expiresAt"], sha256)
+                waiting = self.uploading.get(sha256)
+                if waiting is None:
+                    #this thread uploads, others with the same content wait for it
+                    self.uploading[sha256] = threading.Event()
+                    break
+            waiting.wait()
+        try:
+            mimeType = mimeType or mimetypes.guess_type(path)[0] or "application/octet-stream"
+            owner = self.owner
+            remote = owner.guarded("files", lambda: owner.client.files.upload(
+                file=path, config={"mime_type": mimeType, "display_name": os.path.basename(path)}
+            ), payload=os.path.getsize(path))
+            remote = self.waitUntilActive(remote)
+            expires = getattr(remote, "expiration_time", None)
+            expiresAt = expires.timestamp() if expires else time.time() + 47 * 3600
+            handle = mediaHandle(remote.name, remote.uri, remote.mime_type or mimeType, expiresAt, sha256)
+            with self.lock:
+                self.loadIndex()[sha256] = {
+                    "name": handle.name, "uri": handle.uri, "mimeType": handle.mimeType, "expiresAt": handle.expiresAt
+                }
+                self.saveIndex()
+                self.uploads += 1
+            return handle
+        finally:
+            with self.lock:
+                self.uploading.pop(sha256).set()
+
+    def uploadMany(self, paths, progress=None):
+        #uploads several files concurrently, handles are in the same order as paths
+        #progress is called with (finished, total, path) as each file finishes
+        paths = list(paths)
+        handles = [None] * len(paths)
+        finished = 0
+        with concurrent.futures.ThreadPoolExecutor(max(1, min(self.maxWorkers, len(paths)))) as pool:
+            futures = {pool.submit(self.upload, path): index for index, path in enumerate(paths)}
+            for future in concurrent.futures.as_completed(futures):
+                index = futures[future]
+                handles[index] = future.result()
+                finished += 1
+                if progress:
+                    progress(finished, len(paths), paths[index])
+        return handles
+
+    def forget(self, path):
+        #removes a file from the index and deletes the remote copy
+        sha256 = self.hashFile(path)
+        with self.lock:
+            entry = self.loadIndex().pop(sha256, None)
+            self.saveIndex()
+        if entry:
+            try:
+                owner = self.owner
+                owner.guarded("files", lambda: owner.client.files.delete(name=entry["name"]))
+            except Exception as e:
+                print(f"There was an error: {str(e)}")
+
+    def getStats(self):
+        #returns how many files were uploaded and how many uploads were avoided
+        with self.lock:
+            return {"uploads": self.uploads, "reused": self.reused, "indexed": len(self.loadIndex())}
+
+class batchResult():
+    #The outcome of one prompt in a batch, error is set instead of response when the prompt failed
+    def __init__(self, index, contents):
+        self.index = index
+        self.contents = contents
+        self.response = None
+        self.error = None
+        #files saved for this item, used by image batches
+        self.paths = []
+        self.thumbnails = []
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def text(self):
+        if self.response:
+            return self.response.text
+
+def normaliseValue(value):
+    #Turns contents and configs into plain JSON values, images and bytes are reduced to their hash
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if isinstance(value, (bytes, bytearray)):
+        return {"bytes": hashlib.sha256(value).hexdigest()}
+    if isinstance(value, (list, tuple)):
+        return [normaliseValue(item) for item in value]
+    if isinstance(value, dict):
+        return {str(k): normaliseValue(v) for k, v in sorted(value.items(), key=lambda item: str(item[0]))}
+    if hasattr(value, "model_dump"):
+        return normaliseValue(value.model_dump(exclude_none=True))
+    if hasattr(value, "tobytes") and hasattr(value, "mode") and hasattr(value, "size"):
+        #PIL images from openImage
+        return {"image": hashlib.sha256(value.tobytes()).hexdigest(), "mode": value.mode, "size": list(value.size)}
+    return repr(value)
+
+def hashRequest(*parts):
+    #returns a stable SHA-256 of the given request parts
+    payload = json.dumps([normaliseValue(part) for part in parts], sort_keys=True, default=repr)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class responseCache():
+    #Caches responses by a stable hash of the model, contents and config
+    #An in memory LRU tier sits in front of an optional on disk tier (diskPath)
+    #Disk entries are JSON, responses are stored with model_dump_json, so reading a shared cache folder cannot run code
+    #ttl is in seconds, None keeps entries until they are evicted for space
+    def __init__(self, maxEntries=1024, ttl=None, diskPath=None, diskMaxBytes=256 * 1024 * 1024):
+        self.maxEntries = maxEntries
+        self.ttl = ttl
+        self.diskPath = diskPath
+        self.diskMaxBytes = diskMaxBytes
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.diskHits = 0
+        self.evictions = 0
+        self.diskBytes = 0
+        if diskPath:
+            os.makedirs(diskPath, exist_ok=True)
+            self.diskBytes = sum(entry.stat().st_size for entry in os.scandir(diskPath) if entry.name.endswith(".json"))
+
+    def makeKey(self, model, contents, config):
+        #returns the cache key for a request
+        return hashRequest(model, contents, config)
+
+    def get(self, key):
+        #returns the cached value or None
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                storedAt, value = entry
+                if self.ttl is None or now - storedAt < self.ttl:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self.entries[key]
+        value = self.getFromDisk(key, now)
+        with self.lock:
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.diskHits += 1
+            self.storeInMemory(key, value, now)
+        return value
+
+    def put(self, key, value):
+        #stores a value in every tier
+        now = time.time()
+        with self.lock:
+            self.storeInMemory(key, value, now)
+        self.putOnDisk(key, value)
+
+    async def getAsync(self, key):
+        #async version of get, the disk tier is read on a worker thread so the event loop is not blocked
+        if not self.diskPath:
+            return self.get(key)
+        return await asyncio.to_thread(self.get, key)
+
+    async def putAsync(self, key, value):
+        #async version of put
+        if not self.diskPath:
+            return self.put(key, value)
+        await asyncio.to_thread(self.put, key, value)
+
+    def storeInMemory(self, key, value, storedAt):
+        #caller holds the lock
+        self.entries[key] = (storedAt, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxEntries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def diskFile(self, key):
+        return os.path.join(self.diskPath, f"{key}.json")
+
+    def encode(self, value):
+        #responses, streamed chunks and PCM bytes are the only values the cache holds
+        if isinstance(value, (bytes, bytearray)):
+            return {"kind": "bytes", "data": base64.b64encode(value).decode("ascii")}
+        if isinstance(value, list):
+            return {"kind": "stream", "data": [chunk.model_dump_json(exclude_none=True) for chunk in value]}
+        return {"kind": "response", "data": value.model_dump_json(exclude_none=True)}
+
+    def decode(self, entry):
+        kind, data = entry["kind"], entry["data"]
+        if kind == "bytes":
+            return base64.b64decode(data)
+        if kind == "stream":
+            return [types.GenerateContentResponse.model_validate_json(chunk) for chunk in data]
+        return types.GenerateContentResponse.model_validate_json(data)
+
+    def getFromDisk(self, key, now):
+        if not self.diskPath:
+            return None
+        path = self.diskFile(key)
+        try:
+            if self.ttl is not None and now - os.path.getmtime(path) >= self.ttl:
+                self.removeFromDisk(path)
+                return None
+            with open(path, encoding="utf-8") as f:
+                return self.decode(json.load(f))
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            print(f"There was an error: {str(e)}")
+            self.removeFromDisk(path)
+            return None
+
+    def putOnDisk(self, key, value):
+        if not self.diskPath:
+            return
+        path = self.diskFile(key)
+        temp = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            data = json.dumps(self.encode(value)).encode("utf-8")
+            with open(temp, "wb") as f:
+                f.write(data)
+            #the size of an entry being overwritten is taken off so repeated puts are only counted once
+            with self.lock:
+                try:
+                    replaced = os.path.getsize(path)
+                except OSError:
+                    replaced = 0
+                os.replace(temp, path)
+                self.diskBytes += len(data) - replaced
+        except Exception as e:
+            print(f"There was an error: {str(e)}")
+            if os.path.exists(temp):
+                os.remove(temp)
+            return
+        with self.lock:
+            overLimit = self.diskMaxBytes is not None and self.diskBytes > self.diskMaxBytes
+        if overLimit:
+            self.evictFromDisk()
+
+    def removeFromDisk(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        with self.lock:
+            self.diskBytes -= size
+
+    def evictFromDisk(self):
+        #removes the oldest files until the disk tier is back under three quarters of its limit
+        files = sorted(
+            (entry.stat().st_mtime, entry.path) for entry in os.scandir(self.diskPath) if entry.name.endswith(".json")
+        )
+        for _, path in files:
+            if self.diskBytes <= self.diskMaxBytes * 0.75:
+                break
+            self.removeFromDisk(path)
+            self.evictions += 1
+
+    def clear(self):
+        #empties every tier
+        with self.lock:
+            self.entries.clear()
+        if self.diskPath:
+            for entry in os.scandir(self.diskPath):
+                if entry.name.endswith(".json"):
+                    self.removeFromDisk(entry.path)
+
+    def getStats(self):
+        #returns the hit / miss counters
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "diskHits": self.diskHits,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "diskBytes": self.diskBytes,
+            }
+
+class contextCache():
+    #Manages server side cached content so a large prefix is uploaded once and referenced afterwards
+    #Entries are keyed by a hash of the model, system instruction and contents
+    #The oldest entry is deleted on the server once there are more than maxEntries
+    def __init__(self, owner, ttl=3600, maxEntries=8, refreshMargin=300):
+        self.owner = owner
+        self.ttl = ttl
+        self.maxEntries = maxEntries
+        self.refreshMargin = refreshMargin
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def getOrCreate(self, model, contents, systemInstruction=None):
+        #returns the name of a live cache for this prefix, creating it if needed
+        key = hashRequest(model, contents, systemInstruction)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry["expireAt"] > time.time():
+                self.entries.move_to_end(key)
+                return entry["name"]
+        owner = self.owner
+        #cache calls have their own breaker and do not count against the model's quota
+        cached = owner.guarded("caches", lambda: owner.client.caches.create(
+            model=model,
+            config=types.CreateCachedContentConfig(
+                contents=contents,
+                system_instruction=systemInstruction,
+                ttl=f"{int(self.ttl)}s"
+            )
+        ), payload=[contents, systemInstruction])
+        evicted = []
+        with self.lock:
+            self.entries[key] = {"name": cached.name, "expireAt": time.time() + self.ttl}
+            while len(self.entries) > self.maxEntries:
+                evicted.append(self.entries.popitem(last=False)[1]["name"])
+        for name in evicted:
+            self.deleteRemote(name)
+        return cached.name
+
+    def findEntry(self, name):
+        #caller holds the lock
+        for key, entry in self.entries.items():
+            if entry["name"] == name:
+                return key, entry
+        return None, None
+
+    def refresh(self, name, ttl=None):
+        #extends the ttl of a cache on the server
+        ttl = ttl or self.ttl
+        owner = self.owner
+        owner.guarded("caches", lambda: owner.client.caches.update(
+            name=name, config=types.UpdateCachedContentConfig(ttl=f"{int(ttl)}s")
+        ))
+        with self.lock:
+            _, entry = self.findEntry(name)
+            if entry:
+                entry["expireAt"] = time.time() + ttl
+
+    def keepAlive(self, name):
+        #refreshes a cache that is about to expire, returns False when it has already expired
+        with self.lock:
+            _, entry = self.findEntry(name)
+            if entry is None:
+                return False
+            remaining = entry["expireAt"] - time.time()
+        if remaining <= 0:
+            return False
+        if remaining < self.refreshMargin:
+            self.refresh(name)
+        return True
+
+    def delete(self, name):
+        #removes a cache from the registry and the server
+        with self.lock:
+            key, _ = self.findEntry(name)
+            if key:
+                del self.entries[key]
+        self.deleteRemote(name)
+
+    def deleteRemote(self, name):
+        try:
+            owner = self.owner
+            owner.guarded("caches", lambda: owner.client.caches.delete(name=name))
+        except Exception as e:
+            print(f"There was an error: {str(e)}")
+
+    def clear(self):
+        #deletes every cache this registry created
+        with self.lock:
+            names = [entry["name"] for entry in self.entries.values()]
+            self.entries.clear()
+        for name in names:
+            self.deleteRemote(name)
+
+class textStream():
+    #Wraps a stream of response chunks, iterating it (for or async for) yields each text delta as it arrives
+    #callbacks are called with (text, chunk) for every delta
+    #the full text, usage metadata and timings are kept once the stream has been read
+    def __init__(self, chunks, callbacks=None):
+        self.source = chunks
+        self.callbacks = [callback for callback in (callbacks or []) if callback]
+        self.finishCallbacks = []
+        self.parts = []
+        self.fullText = None
+        self.usageMetadata = None
+        self.chunkCount = 0
+        self.started = time.perf_counter()
+        self.firstTokenAt = None
+        self.finishedAt = None
+
+    def addCallback(self, callback):
+        #adds a callback for the deltas that have not arrived yet
+        self.callbacks.append(callback)
+
+    def handle(self, chunk):
+        #records one chunk and returns its text
+        self.chunkCount += 1
+        usage = getattr(chunk, "usage_metadata", None)
+        if usage:
+            self.usageMetadata = usage
+        text = getattr(chunk, "text", None)
+        if text:
+            if self.firstTokenAt is None:
+                self.firstTokenAt = time.perf_counter()
+            self.parts.append(text)
+            for callback in self.callbacks:
+                callback(text, chunk)
+        return text
+
+    def addFinishCallback(self, callback):
+        #callback is called with the stream once it has been read to the end
+        self.finishCallbacks.append(callback)
+
+    def finish(self):
+        if self.finishedAt is None:
+            self.finishedAt = time.perf_counter()
+            for callback in self.finishCallbacks:
+                callback(self)
+
+    def __iter__(self):
+        for chunk in self.source:
+            text = self.handle(chunk)
+            if text:
+                yield text
+        self.finish()
+
+    async def __aiter__(self):
+        async for chunk in self.source:
+            text = self.handle(chunk)
+            if text:
+                yield text
+        self.finish()
+
+    def getText(self):
+        #reads the rest of the stream and returns the full text
+        if self.finishedAt is None:
+            for _ in self:
+                pass
+        return self.text
+
+    async def getTextAsync(self):
+        #async version of getText
+        if self.finishedAt is None:
+            async for _ in self:
+                pass
+        return self.text
+
+    @property
+    def text(self):
+        #the text received so far, joined once the stream has finished
+        if self.fullText is not None:
+            return self.fullText
+        text = "".join(self.parts)
+        if self.finishedAt is not None:
+            self.fullText = text
+            self.parts = [text]
+        return text
+
+    @property
+    def timeToFirstToken(self):
+        #seconds from the request to the first text
+        if self.firstTokenAt is not None:
+            return self.firstTokenAt - self.started
+
+    @property
+    def outputTokens(self):
+        #output tokens from the usage metadata, estimated from the text if there is none
+        if self.usageMetadata and getattr(self.usageMetadata, "candidates_token_count", None):
+            return self.usageMetadata.candidates_token_count
+        return estimateTokens(self.text)
+
+    @property
+    def tokensPerSecond(self):
+        #output tokens per second after the first token
+        if self.firstTokenAt is None:
+            return None
+        end = self.finishedAt or time.perf_counter()
+        if end <= self.firstTokenAt:
+            return None
+        return self.outputTokens / (end - self.firstTokenAt)
+
+    def getStats(self):
+        #returns the timings of the stream
+        return {
+            "timeToFirstToken": self.timeToFirstToken,
+            "tokensPerSecond": self.tokensPerSecond,
+            "outputTokens": self.outputTokens,
+            "chunks": self.chunkCount,
+            "finished": self.finishedAt is not None,
+        }
+
+class managedChat():
+    #A chat that keeps what is sent under tokenBudget
+    #Recent turns are sent as they are, older turns are folded into a rolling summary written by summaryModel
+    #The full transcript is kept locally so the chat history still shows every message
+    def __init__(self, owner, tokenBudget=8000, summaryModel="gemini-2.0-flash-lite", keepTurns=2, countWith="estimate"):
+        self.owner = owner
+        self.tokenBudget = tokenBudget
+        self.summaryModel = summaryModel
+        self.keepTurns = keepTurns
+        #"estimate" counts locally, "api" uses count_tokens once per message
+        self.countWith = countWith
+        self.transcript = []
+        self.tokenCounts = []
+        self.summary = None
+        self.summaryTokens = 0
+        self.summarisedUpTo = 0
+        self.lock = threading.Lock()
+
+    def countTokens(self, content):
+        #counts one message, the result is stored so each message is only counted once
+        if self.countWith == "api":
+            try:
+                owner = self.owner
+                result = owner.guarded(owner.model, lambda: owner.client.models.count_tokens(model=owner.model, contents=[content]))
+                return result.total_tokens
+            except Exception as e:
+                print(f"There was an error: {str(e)}")
+        return estimateTokens(content)
+
+    def append(self, content):
+        self.transcript.append(content)
+        self.tokenCounts.append(self.countTokens(content))
+
+    def windowStart(self, budget):
+        #returns the first transcript index that fits in budget, always on a user turn
+        used = 0
+        start = len(self.transcript)
+        turns = 0
+        for index in range(len(self.transcript) - 1, self.summarisedUpTo - 1, -1):
+            if self.transcript[index].role == "user":
+                turns += 1
+            if used + self.tokenCounts[index] > budget and turns > self.keepTurns:
+                break
+            used += self.tokenCounts[index]
+            start = index
+        while start < len(self.transcript) and self.transcript[start].role != "user":
+            start += 1
+        return start
+
+    def summarise(self, end):
+        #folds transcript[summarisedUpTo:end] into the rolling summary
+        lines = []
+        for content in self.transcript[self.summarisedUpTo:end]:
+            text = " ".join(part.text for part in (content.parts or []) if getattr(part, "text", None))
+            lines.append(f"{content.role}: {text}")
+        prompt = [
+            "Update the summary of this conversation. Keep names, facts, decisions and open questions. Reply with the summary only.",
+            f"Current summary: {self.summary or 'None'}",
+            "New messages:\n" + "\n".join(lines),
+        ]
+        owner = self.owner
+        response = owner.guarded(self.summaryModel, lambda: owner.client.models.generate_content(
+            model=self.summaryModel, contents=prompt,
+            config=types.GenerateContentConfig(temperature=0.1, maxOutputTokens=max(256, self.tokenBudget // 8))
+        ), estimateTokens(prompt), payload=prompt)
+        self.summary = response.text
+        self.summaryTokens = estimateTokens(self.summary)
+        self.summarisedUpTo = end
+
+    def buildContents(self):
+        #returns the summary and the window of recent turns to send
+        available = self.tokenBudget - self.summaryTokens
+        start = self.windowStart(available)
+        if start > self.summarisedUpTo:
+            #folds down to about half the budget so the summary is not rewritten every turn
+            self.summarise(self.windowStart(int(available * 0.5)))
+            start = self.windowStart(self.tokenBudget - self.summaryTokens)
+        contents = []
+        if self.summary:
+            contents.append(types.UserContent(parts=f"Summary of the conversation so far: {self.summary}"))
+            contents.append(types.ModelContent(parts="Understood."))
+        return contents + self.transcript[start:]
+
+    def send(self, message):
+        #sends a message and returns the response
+        with self.lock:
+            self.append(types.UserContent(parts=message))
+            try:
+                response = self.owner.sendRequest(self.buildContents())
+            except Exception:
+                #the message is removed so the transcript only holds answered turns
+                self.transcript.pop()
+                self.tokenCounts.pop()
+                raise
+            content = response.candidates[0].content
+            self.append(content)
+            metadata = getattr(response, "usage_metadata", None)
+            if self.countWith == "estimate" and metadata and getattr(metadata, "candidates_token_count", None):
+                self.tokenCounts[-1] = metadata.candidates_token_count
+            return response
+
+    def getHistory(self):
+        #returns the full transcript
+        return list(self.transcript)
+
+    def getStats(self):
+        #returns how much of the transcript is summarised and the size of the window
+        with self.lock:
+            return {
+                "messages": len(self.transcript),
+                "summarisedMessages": self.summarisedUpTo,
+                "summaryTokens": self.summaryTokens,
+                "transcriptTokens": sum(self.tokenCounts),
+            }
+
+class tokenBudgetError(Exception):
+    #Raised instead of sending a request that would go over a token budget
+    pass
+
+class tokenAccountant():
+    #Counts input tokens before a request is sent and keeps running totals from the responses
+    #Counts are memoised by content hash so repeated prompts are only counted once
+    #A request over a budget is rejected with tokenBudgetError, or with overflow="truncate" its text is cut to fit
+    #One accountant can be shared by several geminiText objects to enforce a shared quota
+    def __init__(self, maxRequestInputTokens=None, maxSessionInputTokens=None, maxSessionOutputTokens=None,
+                 overflow="reject", countWith="api", memoSize=4096):
+        self.maxRequestInputTokens = maxRequestInputTokens
+        self.maxSessionInputTokens = maxSessionInputTokens
+        self.maxSessionOutputTokens = maxSessionOutputTokens
+        self.overflow = overflow
+        #"api" uses count_tokens, "estimate" counts locally
+        self.countWith = countWith
+        self.memoSize = memoSize
+        self.counts = OrderedDict()
+        self.lock = threading.Lock()
+        self.inputTokens = 0
+        self.outputTokens = 0
+        self.totalTokens = 0
+        self.requests = 0
+        self.rejected = 0
+        self.truncated = 0
+
+    def memoGet(self, key):
+        with self.lock:
+            if key in self.counts:
+                self.counts.move_to_end(key)
+                return self.counts[key]
+
+    def memoPut(self, key, count):
+        with self.lock:
+            self.counts[key] = count
+            while len(self.counts) > self.memoSize:
+                self.counts.popitem(last=False)
+
+    def count(self, owner, model, contents):
+        #returns the input token count of contents
+        key = hashRequest(model, contents)
+        count = self.memoGet(key)
+        if count is None:
+            if self.countWith == "api":
+                result = owner.guarded(model, lambda: owner.client.models.count_tokens(model=model, contents=contents))
+                count = result.total_tokens
+            else:
+                count = estimateTokens(contents)
+            self.memoPut(key, count)
+        return count
+
+    async def countAsync(self, owner, model, contents):
+        #async version of count
+        key = hashRequest(model, contents)
+        count = self.memoGet(key)
+        if count is None:
+            if self.countWith == "api":
+                result = await owner.guardedAsync(model, lambda: owner.client.aio.models.count_tokens(model=model, contents=contents))
+                count = result.total_tokens
+            else:
+                count = estimateTokens(contents)
+            self.memoPut(key, count)
+        return count
+
+    def inputLimit(self):
+        #the most input tokens the next request may use
+        limits = []
+        if self.maxRequestInputTokens is not None:
+            limits.append(self.maxRequestInputTokens)
+        if self.maxSessionInputTokens is not None:
+            with self.lock:
+                limits.append(self.maxSessionInputTokens - self.inputTokens)
+        return min(limits) if limits else None
+
+    def truncate(self, contents, tokens, limit):
+        #cuts the longest text in contents by the share of tokens over the limit
+        items = list(contents) if isinstance(contents, (list, tuple)) else [contents]
+        texts = [index for index, item in enumerate(items) if isinstance(item, str)]
+        if not texts:
+            return None
+        longest = max(texts, key=lambda index: len(items[index]))
+        excess = (tokens - limit) / max(tokens, 1)
+        keep = int(len(items[longest]) * (1 - excess) * 0.95)
+        if keep <= 0:
+            return None
+        items[longest] = items[longest][:keep]
+        return items if isinstance(contents, (list, tuple)) else items[0]
+
+    def limitOutput(self, config):
+        #lowers maxOutputTokens to what is left of the session output budget
+        if self.maxSessionOutputTokens is None:
+            return config
+        with self.lock:
+            remaining = self.maxSessionOutputTokens - self.outputTokens
+            if remaining <= 0:
+                self.rejected += 1
+        if remaining <= 0:
+            raise tokenBudgetError("The session output token budget has been used up")
+        current = getattr(config, "max_output_tokens", None)
+        if config is not None and (current is None or current > remaining):
+            return config.model_copy(update={"max_output_tokens": remaining})
+        return config
+
+    def checkInput(self, contents, tokens, recount):
+        #returns contents that fit the input budgets, recount(contents) counts truncated contents
+        limit = self.inputLimit()
+        if limit is None or tokens <= limit:
+            return contents
+        if self.overflow == "truncate":
+            for _ in range(3):
+                contents = self.truncate(contents, tokens, limit)
+                if contents is None:
+                    break
+                tokens = recount(contents)
+                if tokens <= limit:
+                    with self.lock:
+                        self.truncated += 1
+                    return contents
+        with self.lock:
+            self.rejected += 1
+        raise tokenBudgetError(f"The request needs {tokens} input tokens but only {max(limit, 0)} are allowed")
+
+    def preflight(self, owner, model, contents, config):
+        #counts and checks a request, returns the contents and config to send
+        config = self.limitOutput(config)
+        tokens = self.count(owner, model, contents)
+        contents = self.checkInput(contents, tokens, lambda cut: self.count(owner, model, cut))
+        return contents, config
+
+    async def preflightAsync(self, owner, model, contents, config):
+        #async version of preflight, truncated contents are recounted locally
+        config = self.limitOutput(config)
+        tokens = await self.countAsync(owner, model, contents)
+        contents = self.checkInput(contents, tokens, estimateTokens)
+        return contents, config
+
+    def record(self, usage):
+        #adds the usage metadata of a response to the running totals
+        if usage is None:
+            return
+        with self.lock:
+            self.requests += 1
+            self.inputTokens += getattr(usage, "prompt_token_count", None) or 0
+            self.outputTokens += getattr(usage, "candidates_token_count", None) or 0
+            self.totalTokens += getattr(usage, "total_token_count", None) or 0
+
+    def getUsage(self):
+        #returns the running totals
+        with self.lock:
+            return {
+                "requests": self.requests,
+                "inputTokens": self.inputTokens,
+                "outputTokens": self.outputTokens,
+                "totalTokens": self.totalTokens,
+                "rejected": self.rejected,
+                "truncated": self.truncated,
+            }
+
+    def reset(self):
+        #starts a new session
+        with self.lock:
+            self.inputTokens = self.outputTokens = self.totalTokens = self.requests = 0
+            self.rejected = self.truncated = 0
+
 class geminiText(geminiAI):
     #This class handles the Text generation segment of the Gemini documentation
-    def __init__(self, key):
+    def __init__(self, key, client=None):
         #Declaring and initialising AI variables
-        self.client = genai.Client(api_key=key)
+        self.client = client or genai.Client(api_key=key)
         self.model = "gemini-2.0-flash"
         self.response = None
         self.contents = None
@@ -65,16 +2354,161 @@ class geminiText(geminiAI):
         self.maxOutputTokens = 500
         self.temperature = 0.1
         self.chat = None
+        self.managedChat = None
         self.configs = None
+        self.cache = None
+        self.tokenAccountant = None
+        self.contextCache = None
+        self.cachedContent = None
+        self.cachedContents = None
         self.updateConfig()
 
+    def enableCache(self, maxEntries=1024, ttl=None, diskPath=None, diskMaxBytes=256 * 1024 * 1024):
+        #Caches responses for identical model, contents and config
+        # i.e. myAI.text.enableCache(ttl=3600, diskPath="Output/cache")
+        self.cache = responseCache(maxEntries, ttl, diskPath, diskMaxBytes)
+
+    def disableCache(self):
+        #Stops caching responses
+        self.cache = None
+
+    def getCacheStats(self):
+        #returns the cache hit / miss counters
+        if self.cache:
+            return self.cache.getStats()
+
+    def useContextCache(self, contents=None, ttl=3600):
+        #Uploads the system instruction and a large shared prefix once, later requests and chats reference it
+        # i.e. myAI.text.useContextCache([document]) then myAI.text.updateContents("What does section 2 say?")
+        try:
+            if self.contextCache is None:
+                self.contextCache = contextCache(self, ttl)
+            self.contextCache.ttl = ttl
+            self.cachedContents = contents
+            self.cachedContent = self.contextCache.getOrCreate(self.model, contents, self.systemInstruction)
+        except Exception as e:
+            print(f"There was an error: {str(e)}")
+            self.cachedContent = None
+        self.updateConfig()
+
+    def clearContextCache(self):
+        #Deletes the server side caches and goes back to sending everything with each request
+        if self.contextCache:
+            self.contextCache.clear()
+        self.cachedContent = None
+        self.cachedContents = None
+        self.updateConfig()
+
+    def keepContextCacheAlive(self):
+        #Extends the cache ttl before it runs out, recreates it if it has expired
+        if self.cachedContent and self.contextCache:
+            try:
+                if not self.contextCache.keepAlive(self.cachedContent):
+                    self.useContextCache(self.cachedContents, self.contextCache.ttl)
+            except Exception as e:
+                print(f"There was an error: {str(e)}")
+
+    async def keepContextCacheAliveAsync(self):
+        #async version of keepContextCacheAlive, a refresh runs on a worker thread
+        if self.cachedContent and self.contextCache:
+            await asyncio.to_thread(self.keepContextCacheAlive)
+
+    def updateModel(self, newModel):
+        #cached content belongs to one model so it is recreated for the new one
+        if newModel:
+            self.model = newModel
+            if self.cachedContent:
+                self.useContextCache(self.cachedContents, self.contextCache.ttl)
+
+    def enableTokenBudget(self, maxRequestInputTokens=None, maxSessionInputTokens=None, maxSessionOutputTokens=None,
+                          overflow="reject", countWith="api", accountant=None):
+        #Counts tokens before each request and enforces the budgets, pass accountant to share one between objects
+        # i.e. myAI.text.enableTokenBudget(maxRequestInputTokens=30000, overflow="truncate")
+        self.tokenAccountant = accountant or tokenAccountant(
+            maxRequestInputTokens, maxSessionInputTokens, maxSessionOutputTokens, overflow, countWith
+        )
+
+    def disableTokenBudget(self):
+        #Stops counting and enforcing budgets
+        self.tokenAccountant = None
+
+    def getTokenUsage(self):
+        #returns the running token totals
+        if self.tokenAccountant:
+            return self.tokenAccountant.getUsage()
+
+    def countTokens(self, contents=None):
+        #returns the input token count of contents (the current contents by default), memoised by content hash
+        contents = contents or self.contents
+        try:
+            accountant = self.tokenAccountant or tokenAccountant()
+            return accountant.count(self, self.model, contents)
+        except Exception as e:
+            print(f"There was an error: {str(e)}")
+
+    def recordUsage(self, response):
+        #adds the token usage of a response to the running totals
+        if self.tokenAccountant and response is not None:
+            self.tokenAccountant.record(getattr(response, "usage_metadata", None))
+
+    def sendRequest(self, contents, config=None, model=None):
+        #Sends a single generate_content request, defaults to the current model and config
+        self.keepContextCacheAlive()
+        model, config = model or self.model, config or self.configs
+        if self.tokenAccountant:
+            contents, config = self.tokenAccountant.preflight(self, model, contents, config)
+        if self.cache:
+            key = self.cache.makeKey(model, contents, config)
+            cached = self.cache.get(key)
+            if cached is not None and not isinstance(cached, list):
+                return cached
+        response = self.guarded(model, lambda: self.client.models.generate_content(
+            model=model, contents=contents, config=config
+        ), estimateTokens(contents), payload=contents)
+        self.recordUsage(response)
+        if self.cache:
+            self.cache.put(key, response)
+        return response
+
+    async def sendRequestAsync(self, contents, config=None, model=None):
+        #Async version of sendRequest
+        await self.keepContextCacheAliveAsync()
+        model, config = model or self.model, config or self.configs
+        if self.tokenAccountant:
+            contents, config = await self.tokenAccountant.preflightAsync(self, model, contents, config)
+        if self.cache:
+            key = self.cache.makeKey(model, contents, config)
+            cached = await self.cache.getAsync(key)
+            if cached is not None and not isinstance(cached, list):
+                return cached
+        response = await self.guardedAsync(model, lambda: self.client.aio.models.generate_content(
+            model=model, contents=contents, config=config
+        ), estimateTokens(contents), payload=contents)
+        self.recordUsage(response)
+        if self.cache:
+            await self.cache.putAsync(key, response)
+        return response
+
+    def cachedStream(self, key, stream):
+        #Passes the chunks through and stores them once the stream has finished
+        chunks = []
+        for chunk in stream:
+            chunks.append(chunk)
+            yield chunk
+        self.cache.put(key, chunks)
+
+    def replayStream(self, cached):
+        #Replays a cached stream, a cached full response is replayed as a single chunk
+        if isinstance(cached, list):
+            yield from cached
+        else:
+            yield cached
+
     def AiResponse(self):
         #Gets a one time response from Gemini
         try:
             if self.contents:
-                self.response = self.client.models.generate_content(
-                    model=self.model, contents=self.contents, config=self.configs
-                )
+                self.response = self.sendRequest(self.contents)
         except Exception as e:
             print(f"There was an error: {str(e)}")
         
@@ -82,33 +2516,223 @@ class geminiText(geminiAI):
         #Gets a one time response from Gemini
         try:
             if self.contents:
-                self.response = self.client.models.generate_content_stream(
-                    model=self.model, contents=self.contents, config=self.configs
-                )
+                self.keepContextCacheAlive()
+                if self.cache:
+                    key = self.cache.makeKey(self.model, self.contents, self.configs)
+                    cached = self.cache.get(key)
+                    if cached is not None:
+                        self.response = textStream(self.replayStream(cached))
+                        return
+                contents, config = self.contents, self.configs
+                if self.tokenAccountant:
+                    contents, config = self.tokenAccountant.preflight(self, self.model, contents, config)
+                #the stream only connects when iterated, so this limits the rate but does not retry
+                stream = self.guarded(self.model, lambda: self.client.models.generate_content_stream(
+                    model=self.model, contents=contents, config=config
+                ), estimateTokens(contents), payload=contents)
+                if self.cache:
+                    stream = self.cachedStream(key, stream)
+                self.response = textStream(stream)
+                if self.tokenAccountant:
+                    self.response.addFinishCallback(lambda finished: self.tokenAccountant.record(finished.usageMetadata))
+        except Exception as e:
+            print(f"There was an error: {str(e)}")
+
+    def streamText(self, callback=None):
+        #Streams the current contents, iterate the returned textStream for the text as it arrives
+        # i.e. for text in myAI.text.streamText(): print(text, end="")
+        self.AiResponseStream()
+        if isinstance(self.response, textStream):
+            if callback:
+                self.response.addCallback(callback)
+            return self.response
+
+    def streamTextAsync(self, callback=None):
+        #Async version of streamText, use async for on the returned textStream
+        return textStream(self.AiResponseStreamAsync(), [callback])
+
+    async def AiResponseAsync(self):
+        #Async version of AiResponse, also returns the response so concurrent calls can keep their own
+        try:
+            if self.contents:
+                self.response = await self.sendRequestAsync(self.contents)
+                return self.response
         except Exception as e:
             print(f"There was an error: {str(e)}")
+
+    async def AiResponseStreamAsync(self):
+        #Async version of AiResponseStream, yields each chunk as it arrives
+        # i.e. async for chunk in myAI.text.AiResponseStreamAsync(): print(chunk.text, end="")
+        try:
+            if self.contents:
+                await self.keepContextCacheAliveAsync()
+                if self.cache:
+                    key = self.cache.makeKey(self.model, self.contents, self.configs)
+                    cached = await self.cache.getAsync(key)
+                    if cached is not None:
+                        for chunk in self.replayStream(cached):
+                            yield chunk
+                        return
+                contents, config = self.contents, self.configs
+                if self.tokenAccountant:
+                    contents, config = await self.tokenAccountant.preflightAsync(self, self.model, contents, config)
+                stream = await self.guardedAsync(self.model, lambda: self.client.aio.models.generate_content_stream(
+                    model=self.model, contents=contents, config=config
+                ), estimateTokens(contents), payload=contents)
+                chunks = []
+                async for chunk in stream:
+                    chunks.append(chunk)
+                    yield chunk
+                if self.tokenAccountant and chunks:
+                    self.tokenAccountant.record(getattr(chunks[-1], "usage_metadata", None))
+                if self.cache:
+                    await self.cache.putAsync(key, chunks)
+        except Exception as e:
+            print(f"There was an error: {str(e)}")
+
+    async def AiResponseBatchAsync(self, prompts, concurrency=8, ordered=True):
+        #Runs many prompts with at most concurrency requests in flight and yields a batchResult for each
+        #prompts can be any iterable, each item is the contents or a dict with "contents" and optional "config" / "model"
+        #ordered yields results in input order, otherwise they are yielded as they complete
+        #a failed prompt only sets the error on its own result
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+        items = enumerate(prompts)
+        results = asyncio.Queue()
+        #limits how far workers can run ahead of the consumer so the buffer stays bounded
+        window = asyncio.Semaphore(concurrency * 4)
+
+        async def worker():
+            while True:
+                await window.acquire()
+                try:
+                    index, item = next(items)
+                except StopIteration:
+                    window.release()
+                    return
+                if isinstance(item, dict):
+                    contents, config, model = item.get("contents"), item.get("config"), item.get("model")
+                else:
+                    contents, config, model = item, None, None
+                result = batchResult(index, contents)
+                try:
+                    result.response = await self.sendRequestAsync(contents, config=config, model=model)
+                except Exception as e:
+                    result.error = e
+                results.put_nowait(result)
+
+        async def runWorkers():
+            try:
+                async with asyncio.TaskGroup() as tg:
+                    for _ in range(concurrency):
+                        tg.create_task(worker())
+            finally:
+                results.put_nowait(None)
+
+        runner = asyncio.ensure_future(runWorkers())
+        pending = {}
+        nextIndex = 0
+        try:
+            while True:
+                result = await results.get()
+                if result is None:
+                    break
+                if not ordered:
+                    window.release()
+                    yield result
+                    continue
+                pending[result.index] = result
+                while nextIndex in pending:
+                    window.release()
+                    yield pending.pop(nextIndex)
+                    nextIndex += 1
+            #re raises an error from the prompt iterable itself
+            await runner
+        finally:
+            if not runner.done():
+                runner.cancel()
+
+    def AiResponseBatch(self, prompts, concurrency=8, ordered=True, callback=None):
+        #Runs a batch from synchronous code and returns the list of batchResult
+        #callback is called with each result as it is yielded, i.e. for progress reporting
+        async def run():
+            collected = []
+            async for result in self.AiResponseBatchAsync(prompts, concurrency, ordered):
+                if callback:
+                    callback(result)
+                collected.append(result)
+            return collected
+        return asyncio.run(run())
             
     def startChat(self):
         #Initiatalises a chat 
         try:
+            self.keepContextCacheAlive()
+            self.managedChat = None
             self.chat = self.client.chats.create(model=self.model, config=self.configs)
         except Exception as e:
             print(f"There was an error: {str(e)}")
+
+    def startManagedChat(self, tokenBudget=8000, summaryModel="gemini-2.0-flash-lite", keepTurns=2, countWith="estimate"):
+        #Initialises a chat that never sends more than tokenBudget tokens of history
+        #older turns are folded into a summary written by the cheaper summaryModel
+        self.chat = None
+        self.managedChat = managedChat(self, tokenBudget, summaryModel, keepTurns, countWith)
         
     def sendChatMessage(self, message):
         #Sends a chat message
+        if self.managedChat:
+            try:
+                self.response = self.managedChat.send(message)
+            except Exception as e:
+                print(f"There was an error: {str(e)}")
+            return
         if self.chat:
-            self.response = self.chat.send_message(message)
+            config = None
+            if self.tokenAccountant:
+                message, limited = self.preflightChat(message)
+                #only passed on when the output budget lowered maxOutputTokens, otherwise the chat keeps its own config
+                config = limited if limited is not self.configs else None
+            if not self.cache:
+                self.response = self.guarded(self.model, lambda: self.chat.send_message(message, config=config), estimateTokens(message), payload=message)
+                self.recordUsage(self.response)
+                return
+            #the history is part of the key so only identical conversations share a response
+            history = self.chat.get_history()
+            key = self.cache.makeKey(self.model, [history, message], self.configs)
+            cached = self.cache.get(key)
+            if cached is not None and not isinstance(cached, list):
+                self.response = cached
+                #the chat is rebuilt locally so the cached turn is part of its history
+                self.chat = self.client.chats.create(
+                    model=self.model, config=self.configs,
+                    history=history + [types.UserContent(parts=message), cached.candidates[0].content]
+                )
+                return
+            self.response = self.guarded(self.model, lambda: self.chat.send_message(message, config=config), estimateTokens(message), payload=message)
+            self.recordUsage(self.response)
+            self.cache.put(key, self.response)
+
+    def preflightChat(self, message):
+        #checks the history plus the new message against the token budgets, only the message is ever truncated
+        #returns the message and config to send
+        history = list(self.chat.get_history())
+        parts = list(message) if isinstance(message, (list, tuple)) else [message]
+        contents, config = self.tokenAccountant.preflight(self, self.model, history + parts, self.configs)
+        parts = contents[len(history):]
+        return (parts if isinstance(message, (list, tuple)) else parts[0]), config
         
     def chatHistory(self):
         #returns the chat history
+        if self.managedChat:
+            return self.managedChat.getHistory()
         if self.chat:
             return self.chat.get_history()
     
     def displayChatHistory(self):
         #Displays the Chat history
-        if self.chat:
-            for message in self.chat.get_history():
+        if self.chat or self.managedChat:
+            for message in self.chatHistory():
                 print(f'role - {message.role}',end=": ")
                 print(message.parts[0].text)
             
@@ -128,10 +2752,22 @@ class geminiText(geminiAI):
     def updateSystemInstruction(self, newSystemInstruction):
         #Updates the role (Character)
         self.systemInstruction = newSystemInstruction
+        if self.cachedContent:
+            #the instruction lives in the cached content so the cache is recreated
+            self.useContextCache(self.cachedContents, self.contextCache.ttl)
+            return
         self.updateConfig()
         
     def updateConfig(self):
         #Updates the config when changed
+        if self.cachedContent:
+            #the system instruction is already part of the cached content
+            self.configs = types.GenerateContentConfig(
+                cached_content=self.cachedContent,
+                maxOutputTokens=self.maxOutputTokens,
+                temperature=self.temperature
+            )
+            return
         self.configs = types.GenerateContentConfig(
             systemInstruction=self.systemInstruction,
             maxOutputTokens=self.maxOutputTokens,
@@ -140,6 +2776,11 @@ class geminiText(geminiAI):
             
     def updateContents(self, newContents):
         #Updates the Contents of the message (Prompt)
+        #media handles from uploadMedia are turned into file parts
+        if isinstance(newContents, mediaHandle):
+            newContents = newContents.asPart()
+        elif isinstance(newContents, (list, tuple)):
+            newContents = [item.asPart() if isinstance(item, mediaHandle) else item for item in newContents]
         self.contents = [newContents]
         
     def openImage(self, Link=""):
@@ -147,21 +2788,26 @@ class geminiText(geminiAI):
         #To get a response contents must be set to [self.openImage(Link), "Prompt"]
         # i.e. myAI.updateContents([myAI.openImage("Image.png"), "What is this image?"])
         if os.path.isfile(Link):
-            return Image.open(Link)
+            return self.loadImage(Link)
         
     def getResponse(self):
         #returns a full response all at once
+        if isinstance(self.response, textStream):
+            return self.response.getText()
         if self.response:
             return self.response.text
         
     def displayResponse(self):
         #Displays a full response all at once
         if self.response:
-            print(self.response.text)
+            print(self.getResponse())
         
     def displayChunkResponse(self):
         #displays the response as it arrives
-        if self.response:
+        if isinstance(self.response, textStream):
+            for text in self.response:
+                print(text, end="")
+        elif self.response:
             for chunk in self.response:
                 print(chunk.text, end="")
 
@@ -180,8 +2826,8 @@ class geminiImage(geminiAI):
 
     
     """
-    def __init__(self, key):
-        self.client = genai.Client(api_key=key)
+    def __init__(self, key, client=None):
+        self.client = client or genai.Client(api_key=key)
         self.model ="gemini-2.0-flash-preview-image-generation"
         self.response = None
         self.contents = None
@@ -194,13 +2840,30 @@ class geminiImage(geminiAI):
             if self.image:
                 self.contents = [self.contents, self.image]
             if self.contents:
-                self.response = self.client.models.generate_content(
+                self.response = self.guarded(self.model, lambda: self.client.models.generate_content(
                     model=self.model,
                     contents=self.contents,
                     config=types.GenerateContentConfig(
                     response_modalities=['TEXT', 'IMAGE']
                     )
-                )
+                ), payload=self.contents)
+        except Exception as e:
+            print(f"There was an error: {str(e)}")
+
+    async def getResponseAsync(self):
+        #Async version of getResponse
+        try:
+            if self.image:
+                self.contents = [self.contents, self.image]
+            if self.contents:
+                self.response = await self.guardedAsync(self.model, lambda: self.client.aio.models.generate_content(
+                    model=self.model,
+                    contents=self.contents,
+                    config=types.GenerateContentConfig(
+                    response_modalities=['TEXT', 'IMAGE']
+                    )
+                ), payload=self.contents)
+                return self.response
         except Exception as e:
             print(f"There was an error: {str(e)}")
 
@@ -217,7 +2880,7 @@ class geminiImage(geminiAI):
         # image link should be addded last
         try:
             if os.path.exists(path):
-                self.image = PIL.Image.open(path)
+                self.image = self.loadImage(path)
         except Exception as e:
             print(f"There was an error: {str(e)}")
 
@@ -237,6 +2900,7 @@ class geminiImage(geminiAI):
     def displayImage(self):
         #displays the image portion of the response
         if self.response:
+            from PIL import Image
             for part in self.response.candidates[0].content.parts:
                 if part.inline_data is not None:
                     image = Image.open(BytesIO((part.inline_data.data)))
@@ -257,14 +2921,13 @@ class geminiImage(geminiAI):
 
     def saveImage(self):
         #saves image to output folder
+        #the save runs in the background, returns a future per image (see flushOutput)
         if self.response:
+            saves = []
             for part in self.response.candidates[0].content.parts:
                 if part.inline_data is not None:
-                    _, _, files = next(os.walk("Output"))
-                    file_count = len(files)
-
-                    image = Image.open(BytesIO((part.inline_data.data)))
-                    image.save(f'Output/new_image{file_count}.jpg')
+                    saves.append(self.getOutput().saveImageBytes(part.inline_data.data, "new_image", ".jpg"))
+            return saves
         else:
             return None
 
@@ -278,8 +2941,8 @@ class Imagegen(geminiAI):
     Infusing branding, style, or generating logos and product designs.
 
   """
-  def __init__(self, Key):
-      self.client = genai.Client(api_key=Key)
+  def __init__(self, Key, client=None):
+      self.client = client or genai.Client(api_key=Key)
       self.model='imagen-3.0-generate-002'
       self.response = None
       self.numberOfImages = 1
@@ -287,20 +2950,75 @@ class Imagegen(geminiAI):
       self.personGeneration = "allow_adult"
       self.contents = None
       self.image = None
-      self.config = None
+      self.configs = None
       self.updateConfig()
 
   def generateImage(self):
     #THis uses imagen3 to generate an image
     try:
-        self.response = self.client.models.generate_images(
+        self.response = self.guarded(self.model, lambda: self.client.models.generate_images(
             model=self.model,
             prompt=self.contents,
-            config=self.config
-        )
+            config=self.configs
+        ), payload=self.contents)
+    except Exception as e:
+            print(f"There was an error: {str(e)}")
+
+  async def generateImageAsync(self):
+    #Async version of generateImage
+    try:
+        self.response = await self.guardedAsync(self.model, lambda: self.client.aio.models.generate_images(
+            model=self.model,
+            prompt=self.contents,
+            config=self.configs
+        ), payload=self.contents)
+        return self.response
     except Exception as e:
             print(f"There was an error: {str(e)}")
 
+  async def generateImageBatchAsync(self, prompts, concurrency=4, format=None, thumbnailSize=None, progress=None):
+    #Generates every prompt with at most concurrency requests in flight and saves the images on the writer pool
+    #Returns a batchResult per prompt in input order, with the saved paths and thumbnails, or the error
+    #format (".jpg", ".png", ".webp") transcodes, by default the returned bytes are written as they are
+    #thumbnailSize (i.e. (256, 256)) writes a thumbnail from the same decode
+    #progress is called with (result, finished, total) as each prompt finishes
+    prompts = list(prompts)
+    results = [batchResult(index, prompt) for index, prompt in enumerate(prompts)]
+    limit = asyncio.Semaphore(concurrency)
+    finished = 0
+    output = self.getOutput()
+
+    async def run(result):
+      nonlocal finished
+      try:
+        async with limit:
+          result.response = await self.guardedAsync(self.model, lambda: self.client.aio.models.generate_images(
+              model=self.model,
+              prompt=result.contents,
+              config=self.configs
+          ), payload=result.contents)
+        saves = [
+          output.saveGeneratedImage(generated.image.image_bytes, generated.image.mime_type, "new_image", format, thumbnailSize)
+          for generated in (result.response.generated_images or [])
+        ]
+        for path, thumbnail in await asyncio.gather(*(asyncio.wrap_future(save) for save in saves)):
+          result.paths.append(path)
+          if thumbnail:
+            result.thumbnails.append(thumbnail)
+      except Exception as e:
+        result.error = e
+      finished += 1
+      if progress:
+        progress(result, finished, len(prompts))
+
+    await asyncio.gather(*(run(result) for result in results))
+    return results
+
+  def generateImageBatch(self, prompts, concurrency=4, format=None, thumbnailSize=None, progress=None):
+    #Runs generateImageBatchAsync from synchronous code
+    # i.e. myAI.imagen3.generateImageBatch(["A red chair", "A blue lamp"], thumbnailSize=(256, 256))
+    return asyncio.run(self.generateImageBatchAsync(prompts, concurrency, format, thumbnailSize, progress))
+
   def updateContents(self, newContents):
     #Updates prompt
     if type(newContents) == str:
@@ -345,6 +3063,7 @@ class Imagegen(geminiAI):
   def displayImage(self):
     #If response is generated it displays the image
     if self.response:
+      from PIL import Image
       for generated_image in self.response.generated_images:
         image = Image.open(BytesIO(generated_image.image.image_bytes))
         image.show()
@@ -353,20 +3072,176 @@ class Imagegen(geminiAI):
 
   def saveImage(self):
     #if response is generated it saves the image
+    #the save runs in the background, returns a future per image (see flushOutput)
     if self.response:
-      _, _, files = next(os.walk("Output"))
-      file_count = len(files)
-      if self.response.generated_images.generated_images:
+      saves = []
+      if self.response.generated_images:
         for generated_image in self.response.generated_images:
-            img = Image.open(BytesIO(generated_image.image.image_bytes))
-            img.save(f'Output/new_image{file_count}.jpg')
+            saves.append(self.getOutput().saveImageBytes(generated_image.image.image_bytes, "new_image", ".jpg"))
+      return saves
     else:
         return None
     
+class videoJob():
+    #Handle for one submitted Veo operation, future resolves to the list of saved file paths
+    def __init__(self, operation, callback=None, interval=5, download=True):
+        self.operation = operation
+        self.callback = callback
+        self.download = download
+        self.future = concurrent.futures.Future()
+        self.interval = interval
+        self.nextPoll = time.monotonic() + interval
+        self.submitted = time.time()
+        #the caption of the starting image, a string, a Future while it is being written, or None
+        self.caption = None
+
+    def done(self):
+        return self.future.done()
+
+    def getCaption(self, timeout=None):
+        #returns the caption of the starting image, waiting for it if it is still being written
+        if isinstance(self.caption, concurrent.futures.Future):
+            return self.caption.result(timeout)
+        return self.caption
+
+    def result(self, timeout=None):
+        #waits for the video and returns the saved paths
+        return self.future.result(timeout)
+
+class videoJobManager():
+    #Polls every pending Veo operation from one background thread, finished videos are downloaded on the output writer pool
+    #Each job starts polling after minInterval seconds and backs off by backoff up to maxInterval
+    def __init__(self, owner, minInterval=5, maxInterval=60, backoff=1.5, autoDownload=True):
+        self.owner = owner
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        self.backoff = backoff
+        self.autoDownload = autoDownload
+        self.jobs = []
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+        self.running = False
+
+    def submit(self, prompt, image=None, config=None, callback=None, download=None):
+        #starts a generate_videos operation and returns a videoJob straight away
+        #callback is called with the job once it has finished or failed
+        #download overrides autoDownload for this job
+        owner = self.owner
+        request = {"model": owner.model, "prompt": prompt, "config": config or owner.configs}
+        if image:
+            request["image"] = image
+        operation = owner.guarded(owner.model, lambda: owner.client.models.generate_videos(**request), payload=request)
+        download = self.autoDownload if download is None else download
+        job = videoJob(operation, callback, self.minInterval, download)
+        with self.lock:
+            self.jobs.append(job)
+            self.start()
+        self.wake.set()
+        return job
+
+    def start(self):
+        #caller holds the lock
+        if not self.running:
+            self.running = True
+            self.thread = threading.Thread(target=self.pollLoop, name="veo-poller", daemon=True)
+            self.thread.start()
+
+    def updateIntervals(self, minInterval, maxInterval):
+        #changes the backoff bounds, jobs already waiting longer than maxInterval are brought forward
+        with self.lock:
+            self.minInterval = minInterval
+            self.maxInterval = maxInterval
+            latest = time.monotonic() + maxInterval
+            for job in self.jobs:
+                job.interval = min(job.interval, maxInterval)
+                job.nextPoll = min(job.nextPoll, latest)
+        self.wake.set()
+
+    def pending(self):
+        #returns the number of jobs still running
+        with self.lock:
+            return len(self.jobs)
+
+    def pollLoop(self):
+        while True:
+            with self.lock:
+                if not self.running:
+                    return
+                due = [job for job in self.jobs if job.nextPoll <= time.monotonic()]
+                nextPoll = min((job.nextPoll for job in self.jobs), default=None)
+            for job in due:
+                self.poll(job)
+            if not due:
+                timeout = None if nextPoll is None else max(0, nextPoll - time.monotonic())
+                self.wake.wait(timeout)
+                self.wake.clear()
+
+    def poll(self, job):
+        owner = self.owner
+        try:
+            if not job.operation.done:
+                job.operation = owner.guarded("operations", lambda: owner.client.operations.get(job.operation))
+        except Exception as e:
+            #a failed poll is retried on the next interval
+            print(f"There was an error: {str(e)}")
+        if not job.operation.done:
+            job.interval = min(self.maxInterval, job.interval * self.backoff)
+            job.nextPoll = time.monotonic() + job.interval
+            return
+        with self.lock:
+            self.jobs.remove(job)
+        try:
+            if job.operation.error:
+                raise RuntimeError(f"Video generation failed: {job.operation.error}")
+            saves = owner.submitDownloads(job.operation) if job.download else []
+        except Exception as e:
+            job.future.set_exception(e)
+            self.notify(job)
+            return
+        self.finish(job, saves)
+
+    def finish(self, job, saves):
+        #resolves the job once its downloads are saved, on the writer thread that finished last
+        if not saves:
+            job.future.set_result([])
+            self.notify(job)
+            return
+        remaining = [len(saves)]
+        lock = threading.Lock()
+        def saved(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] > 0:
+                    return
+            try:
+                job.future.set_result([save.result() for save in saves])
+            except Exception as e:
+                job.future.set_exception(e)
+            self.notify(job)
+        for save in saves:
+            save.add_done_callback(saved)
+
+    def notify(self, job):
+        if job.callback:
+            try:
+                job.callback(job)
+            except Exception as e:
+                print(f"There was an error: {str(e)}")
+
+    def shutdown(self, wait=True):
+        #stops polling, jobs that have not finished are left pending
+        with self.lock:
+            self.running = False
+            thread = self.thread
+        self.wake.set()
+        if wait and thread and thread is not threading.current_thread():
+            thread.join()
+
 class videoGeneration(geminiAI):
   # This costs money !!!
-  def __init__(self, Key):
-    self.client = genai.Client(api_key=Key)
+  def __init__(self, Key, client=None):
+    self.client = client or genai.Client(api_key=Key)
     self.model = "veo-2.0-generate-001"
     self.textModel = "gemini-2.0-flash"
     self.contents = None
@@ -379,6 +3254,14 @@ class videoGeneration(geminiAI):
     self.durationSeconds = 5
     #self.enhancePrompt = True ### raise ValueError('enhance_prompt parameter is not supported in Gemini API.'), (So why is it in the fucking docs!?!)
     self.waitTime = 20
+    self.jobManager = None
+    self.caption = None
+    self.captionInPrompt = False
+    self.captionPool = None
+    #the most recent captions, keyed by the SHA-256 of the image bytes, oldest dropped past maxCaptions
+    self.captionMemo = OrderedDict()
+    self.captionLock = threading.Lock()
+    self.maxCaptions = 32
     self.configs=types.GenerateVideosConfig(
       negativePrompt = self.negativeContents,
       person_generation=self.personGeneration,
@@ -390,23 +3273,38 @@ class videoGeneration(geminiAI):
 
   def GenerateVideo(self):
     #if base prompt get response
+    #blocks until the video is ready, use submitVideo to run several at once
     if self.contents:
-      if self.image:
-        self.operation = self.client.models.generate_videos(
-          model = self.model,
-          prompt = self.contents,
-          image = self.image,
-          config = self.configs
-        )
-      else:
-        self.operation = self.client.models.generate_videos(
-          model = self.model,
-          prompt = self.contents,
-          config = self.configs
-        )
+      job = self.getJobManager().submit(self.buildPrompt(), self.image, self.configs, download=False)
+      job.caption = self.caption
+      error = job.future.exception()
+      self.operation = job.operation
+      if error:
+        print(f"There was an error: {str(error)}")
+
+  def submitVideo(self, callback=None):
+    #Starts generating the current prompt and returns a videoJob without waiting
+    #finished videos are downloaded to Output, job.result() returns their paths
+    if self.contents:
+      job = self.getJobManager().submit(self.buildPrompt(), self.image, self.configs, callback)
+      job.caption = self.caption
+      return job
 
-      while not self.operation.done:
-        self.checkFinished()
+  def buildPrompt(self):
+    #adds the caption of the starting image to the prompt when captionInPrompt is set
+    #otherwise the caption is written alongside the job and is available from job.getCaption()
+    if self.captionInPrompt and self.caption:
+      caption = self.caption.result() if isinstance(self.caption, concurrent.futures.Future) else self.caption
+      if caption:
+        return f"{self.contents}\n\nThe starting image shows: {caption}"
+    return self.contents
+
+  def getJobManager(self):
+    #returns the shared background poller, created on first use
+    if self.jobManager is None:
+      #the backoff stops at waitTime so a finished video is noticed no later than the old fixed poll
+      self.jobManager = videoJobManager(self, minInterval=min(5, self.waitTime), maxInterval=self.waitTime)
+    return self.jobManager
 
   def updateContents(self, newContents):
     #Updates prompt
@@ -419,21 +3317,59 @@ class videoGeneration(geminiAI):
         self.contents = newNegativeContent
         self.updateConfig()
 
-  def uploadImage(self, path):
+  def uploadImage(self, path, caption=None, describe=False):
     # This loads and image into the content
     # image link should be addded last
+    #The file is read once and sent as bytes, it is never decoded unless preprocessing is enabled
+    #caption is kept with the job, describe=True asks textModel for one in the background instead
     try:
       if os.path.exists(path):
-        self.response = self.client.models.generate_content(
-            model = self.textModel, contents=[Image.open(path), "What is this image?"], config=self.configs
-        )
-        self.image = [Image.open(path), self.response.text]
+        if self.preprocessor:
+          prepared = self.preprocessor.process(path)
+          data, mimeType = prepared.data, prepared.mimeType
+        else:
+          with open(path, "rb") as f:
+            data = f.read()
+          mimeType = mimetypes.guess_type(path)[0] or "image/png"
+        self.image = types.Image(image_bytes=data, mime_type=mimeType)
+        if caption is not None:
+          self.caption = caption
+        elif describe:
+          self.caption = self.describeImage(data, mimeType)
+        else:
+          self.caption = None
     except Exception as e:
       print(f"There was an error: {str(e)}")
 
+  def describeImage(self, data, mimeType):
+    #returns a Future for the caption of the image, the same image is only captioned once
+    key = hashlib.sha256(data).hexdigest()
+    with self.captionLock:
+      caption = self.captionMemo.get(key)
+      if caption is not None:
+        self.captionMemo.move_to_end(key)
+        return caption
+      if self.captionPool is None:
+        self.captionPool = concurrent.futures.ThreadPoolExecutor(2, thread_name_prefix="veo-caption")
+    def write():
+      response = self.guarded(self.textModel, lambda: self.client.models.generate_content(
+          model = self.textModel, contents=[types.Part.from_bytes(data=data, mime_type=mimeType), "What is this image?"]
+      ), payload=data)
+      with self.captionLock:
+        self.captionMemo[key] = response.text
+        while len(self.captionMemo) > self.maxCaptions:
+          self.captionMemo.popitem(last=False)
+      return response.text
+    return self.captionPool.submit(write)
+
+  def toggleCaptionInPrompt(self):
+    #Waits for the image caption and adds it to the prompt before submitting
+    self.captionInPrompt = not self.captionInPrompt
+
   def checkFinished(self):
     time.sleep(self.waitTime)
-    self.operation = self.client.operations.get(self.operation)
+    #polling has its own breaker and does not count against the veo request quota
+    self.operation = self.guarded("operations", lambda: self.client.operations.get(self.operation))
 
   def updateAspectRatio(self, newAspectRatio):
     #Checks and updates valid aspect ratios for image
@@ -477,8 +3413,10 @@ class videoGeneration(geminiAI):
     #updates the interval between checking
     if type(newTime) == int:
       if 1 <= newTime:
-        self.durationSeconds = newTime
-        self.updateConfig()
+        self.waitTime = newTime
+        if self.jobManager:
+          #the same bounds as getJobManager
+          self.jobManager.updateIntervals(min(5, newTime), newTime)
 
   """def toggleEnhancePrompt(self, state):
     if type(state) == bool:
@@ -497,19 +3435,351 @@ class videoGeneration(geminiAI):
     
   def saveVideo(self):
     #if response is generated save
-    if self.operation.response.generated_videos:
-      for n, generated_video in enumerate(self.operation.response.generated_videos):
-        _, _, files = next(os.walk("Output"))
-        file_count = len(files)
-        self.client.files.download(file=generated_video.video)
-        generated_video.video.save(f"Output/video{file_count}.mp4")  # save the video
+    if self.operation and self.operation.response and self.operation.response.generated_videos:
+      return self.saveOperation(self.operation)
     else:
       return None
+
+  def saveOperation(self, operation):
+    #downloads and saves every video of a finished operation, returns the file paths
+    return [save.result() for save in self.submitDownloads(operation)]
+
+  def submitDownloads(self, operation):
+    #downloads and saves every video of a finished operation on the writer pool, returns a future per video
+    saves = []
+    if operation.response and operation.response.generated_videos:
+      for generated_video in operation.response.generated_videos:
+        saves.append(self.getOutput().saveDownload(lambda video=generated_video.video: self.downloadVideo(video), "video", ".mp4"))
+    return saves
+
+  def downloadVideo(self, video):
+    video.video_bytes = self.guarded("files", lambda: self.client.files.download(file=video))
+    return video.video_bytes
     
+class pcmConverter():
+    #Converts PCM between sample rates, channel counts and sample widths with NumPy
+    #Input is read through np.frombuffer views and converted in whole arrays, identical formats pass straight through
+    #Resampling is linear and carries its position and last frame between chunks so streamed audio has no seams
+    def __init__(self, sourceRate, sourceChannels, sourceWidth, rate, channels, width):
+        self.sourceRate = sourceRate
+        self.sourceChannels = sourceChannels
+        self.sourceWidth = sourceWidth
+        self.rate = rate
+        self.channels = channels
+        self.width = width
+        self.identity = (sourceRate, sourceChannels, sourceWidth) == (rate, channels, width)
+        self.step = sourceRate / rate
+        self.reset()
+
+    def reset(self):
+        #forgets the stream state, call between unrelated streams
+        self.position = 0.0
+        self.tail = None
+        self.remainder = b""
+
+    def convert(self, data):
+        #converts one chunk of PCM and returns bytes in the target format
+        if self.identity:
+            return data
+        import numpy as np
+        frame = self.sourceChannels * self.sourceWidth
+        if self.remainder:
+            data = self.remainder + bytes(data)
+        usable = len(data) // frame * frame
+        #a partial frame is kept for the next chunk
+        self.remainder = bytes(data[usable:])
+        samples = self.decode(np, memoryview(data)[:usable]).reshape(-1, self.sourceChannels)
+        samples = self.mix(np, samples)
+        if self.sourceRate != self.rate:
+            samples = self.resample(np, samples)
+        return self.encode(np, samples)
+
+    def decode(self, np, data):
+        #returns float32 samples in [-1, 1)
+        if self.sourceWidth == 1:
+            #8 bit WAV is unsigned
+            return (np.frombuffer(data, dtype=np.uint8).astype(np.float32) - 128) / 128
+        if self.sourceWidth == 2:
+            return np.frombuffer(data, dtype="<i2").astype(np.float32) / 32768
+        if self.sourceWidth == 3:
+            raw = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+            value = raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)
+            value = np.where(value & 0x800000, value - 0x1000000, value)
+            return value.astype(np.float32) / 8388608
+        return (np.frombuffer(data, dtype="<i4").astype(np.float64) / 2147483648).astype(np.float32)
+
+    def mix(self, np, samples):
+        #down mixes by averaging, up mixes by copying
+        if self.channels == self.sourceChannels:
+            return samples
+        if self.sourceChannels == 1:
+            return np.repeat(samples, self.channels, axis=1)
+        mono = samples.mean(axis=1, keepdims=True)
+        return mono if self.channels == 1 else np.repeat(mono, self.channels, axis=1)
+
+    def resample(self, np, samples):
+        #interpolates between neighbouring frames, the last frame is held back for the next chunk
+        if self.tail is not None:
+            samples = np.concatenate([self.tail, samples])
+        count = len(samples)
+        if count < 2:
+            self.tail = samples
+            return samples[:0]
+        positions = np.arange(self.position, count - 1, self.step)
+        index = positions.astype(np.int64)
+        fraction = (positions - index).astype(np.float32)[:, None]
+        out = samples[index] * (1 - fraction) + samples[index + 1] * fraction
+        nextPosition = positions[-1] + self.step if len(positions) else self.position
+        self.position = nextPosition - (count - 1)
+        self.tail = samples[-1:]
+        return out
+
+    def encode(self, np, samples):
+        samples = np.clip(samples, -1, 1)
+        if self.width == 1:
+            return (samples * 127 + 128).astype(np.uint8).tobytes()
+        if self.width == 2:
+            return (samples * 32767).astype("<i2").tobytes()
+        if self.width == 3:
+            value = (samples * 8388607).astype("<i4")
+            return value.reshape(-1, 1).view(np.uint8)[:, :3].tobytes()
+        return (samples.astype(np.float64) * 2147483647).astype("<i4").tobytes()
+
+class pcmRingBuffer():
+  #Fixed size ring buffer of PCM bytes, allocated once
+  #write blocks while the buffer is full so a fast producer is held back by playback
+  def __init__(self, capacity):
+    self.capacity = capacity
+    self.buffer = bytearray(capacity)
+    self.view = memoryview(self.buffer)
+    self.readPos = 0
+    self.size = 0
+    self.condition = threading.Condition()
+
+  @property
+  def available(self):
+    return self.size
+
+  def write(self, data, timeout=None):
+    #copies data into the buffer, returns False if it timed out before everything fitted
+    data = memoryview(data).cast("B")
+    written = 0
+    with self.condition:
+      while written < len(data):
+        if self.size == self.capacity:
+          if not self.condition.wait(timeout):
+            return False
+          continue
+        writePos = (self.readPos + self.size) % self.capacity
+        count = min(len(data) - written, self.capacity - self.size, self.capacity - writePos)
+        self.view[writePos:writePos + count] = data[written:written + count]
+        self.size += count
+        written += count
+        self.condition.notify_all()
+    return True
+
+  def readInto(self, out):
+    #copies up to len(out) bytes into out without blocking, returns how many were copied
+    out = memoryview(out).cast("B")
+    with self.condition:
+      count = min(len(out), self.size)
+      first = min(count, self.capacity - self.readPos)
+      out[:first] = self.view[self.readPos:self.readPos + first]
+      if count > first:
+        out[first:count] = self.view[:count - first]
+      self.readPos = (self.readPos + count) % self.capacity
+      self.size -= count
+      if count:
+        self.condition.notify_all()
+      return count
+
+class audioEngine():
+  #A long lived PortAudio output stream in callback mode, fed from a preallocated pcmRingBuffer
+  #Utterances are queued back to back in the ring so they play without gaps
+  #Use audioEngine.get(rate, channels, sampleWidth) to share one engine per format and release() when done with it
+  engines = {}
+  enginesLock = threading.Lock()
+
+  def __init__(self, rate=24000, channels=1, sampleWidth=2, bufferSeconds=10, framesPerBuffer=1024):
+    self.rate = rate
+    self.channels = channels
+    self.sampleWidth = sampleWidth
+    self.framesPerBuffer = framesPerBuffer
+    self.bytesPerSecond = rate * channels * sampleWidth
+    self.ring = pcmRingBuffer(self.bytesPerSecond * bufferSeconds)
+    self.block = bytearray(framesPerBuffer * channels * sampleWidth)
+    self.audio = None
+    self.stream = None
+    self.lock = threading.Lock()
+    self.done = threading.Condition()
+    self.written = 0
+    self.played = 0
+    self.underruns = 0
+    self.utterances = 0
+    self.users = 0
+
+  @property
+  def key(self):
+    return (self.rate, self.channels, self.sampleWidth)
+
+  @property
+  def closed(self):
+    return self.stream is None
+
+  @classmethod
+  def get(cls, rate=24000, channels=1, sampleWidth=2):
+    #returns the shared engine for this format, opening the device the first time
+    #every get needs a matching release
+    key = (rate, channels, sampleWidth)
+    with cls.enginesLock:
+      engine = cls.engines.get(key)
+      if engine is None:
+        engine = cls(rate, channels, sampleWidth)
+        cls.engines[key] = engine
+      engine.users += 1
+    try:
+      engine.start()
+    except BaseException:
+      #a device that failed to open is not kept for the next caller
+      with cls.enginesLock:
+        engine.users -= 1
+        if engine.users <= 0 and cls.engines.get(key) is engine:
+          del cls.engines[key]
+      raise
+    return engine
+
+  def release(self):
+    #gives up one use of a shared engine, the device is closed once nobody uses it
+    with self.enginesLock:
+      self.users -= 1
+      if self.users > 0:
+        return
+      if self.engines.get(self.key) is self:
+        del self.engines[self.key]
+    self.close()
+
+  @classmethod
+  def closeAll(cls):
+    #releases every shared engine
+    with cls.enginesLock:
+      engines = list(cls.engines.values())
+      cls.engines.clear()
+    for engine in engines:
+      engine.close()
+
+  def start(self):
+    #opens the device once
+    with self.lock:
+      if self.stream is not None:
+        return
+      import pyaudio
+      audio = pyaudio.PyAudio()
+      try:
+        stream = audio.open(
+          format=audio.get_format_from_width(self.sampleWidth),
+          channels=self.channels,
+          rate=self.rate,
+          output=True,
+          frames_per_buffer=self.framesPerBuffer,
+          stream_callback=self.callback
+        )
+        stream.start_stream()
+      except BaseException:
+        audio.terminate()
+        raise
+      self.audio, self.stream = audio, stream
+
+  def callback(self, inData, frameCount, timeInfo, status):
+    #runs on the PortAudio thread, anything missing from the ring is played as silence
+    import pyaudio
+    size = frameCount * self.channels * self.sampleWidth
+    if len(self.block) < size:
+      self.block = bytearray(size)
+    out = memoryview(self.block)[:size]
+    count = self.ring.readInto(out)
+    if count < size:
+      out[count:] = bytes(size - count)
+      with self.done:
+        if self.written > self.played + count:
+          #audio was queued but did not arrive in time
+          self.underruns += 1
+    with self.done:
+      self.played += count
+      if self.played >= self.written:
+        self.done.notify_all()
+    return (bytes(out), pyaudio.paContinue)
+
+  def write(self, pcm):
+    #queues PCM behind anything already playing, blocks while the ring is full
+    if self.closed:
+      raise RuntimeError("The audio engine is closed")
+    with self.done:
+      self.written += len(pcm)
+    self.ring.write(pcm)
+
+  def enqueue(self, pcm):
+    #queues a whole utterance
+    with self.done:
+      self.utterances += 1
+    self.write(pcm)
+
+  def waitUntilDone(self, timeout=None):
+    #waits until everything queued has been played
+    with self.done:
+      return self.done.wait_for(lambda: self.played >= self.written, timeout)
+
+  def getBufferLevel(self):
+    #seconds of audio waiting in the ring
+    return self.ring.available / self.bytesPerSecond
+
+  def getStats(self):
+    #returns the underrun count and buffer level
+    with self.done:
+      return {
+        "underruns": self.underruns,
+        "bufferSeconds": self.getBufferLevel(),
+        "utterances": self.utterances,
+        "queuedSeconds": (self.written - self.played) / self.bytesPerSecond,
+      }
+
+  def close(self):
+    #stops the stream and releases PortAudio
+    with self.lock:
+      stream, audio = self.stream, self.audio
+      self.stream = self.audio = None
+    if stream is not None:
+      stream.stop_stream()
+      stream.close()
+    if audio is not None:
+      audio.terminate()
+    with self.done:
+      self.played = self.written
+      self.done.notify_all()
+
+  def __enter__(self):
+    self.start()
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
 class speech(geminiAI):
-  def __init__(self, Key):
-    self.client = genai.Client(api_key=Key)
+  #long form chunks are cached by text and voice config once enableChunkCache is called
+  chunkCache = None
+  #MultiSpeech splits on "Name: line" speaker turns
+  speakerTurns = False
+  turnPattern = re.compile(r"^([^:]{1,40}):\s*(\S.*)$")
+  sentencePattern = re.compile(r"(?<=[.!?…])\s+")
+
+  def __init__(self, Key, client=None):
+    self.client = client or genai.Client(api_key=Key)
     self.pcm = None
+    self.stream = None
+    self.firstAudioLatency = None
+    #the model returns 24 kHz mono 16 bit PCM, it is converted to rate, channels and sampleWidth when saved or played
+    self.sourceRate = 24000
+    self.sourceChannels = 1
+    self.sourceWidth = 2
     self.channels = 1
     self.rate = 24000
     self.sampleWidth = 2
@@ -520,52 +3790,270 @@ class speech(geminiAI):
 
   def saveResponse(self):
     #saves audio file to Output
+    #the save runs in the background, returns a future for the path (see flushOutput)
     if self.response.candidates[0]:
-      self.pcm = self.response.candidates[0].content.parts[0].inline_data.data
-      _, _, files = next(os.walk("Output"))
-      file_count = len(files)
-
-      file_name=f'Output/out{file_count}.wav'
-      self.wave_file(file_name)
+      self.pcm = self.convertPcm(self.response.candidates[0].content.parts[0].inline_data.data)
+      return self.getOutput().saveWave(self.pcm, self.channels, self.sampleWidth, self.rate, "out")
 
   def wave_file(self, filename):
     # Set up the wave file to save the output:
-    if self.response:
+    if self.pcm:
       with wave.open(filename, "wb") as wf:
           wf.setnchannels(self.channels)
           wf.setsampwidth(self.sampleWidth)
           wf.setframerate(self.rate)
           wf.writeframes(self.pcm)
 
+  def getResponseStream(self, play=True, save=False, preRoll=0.2, callback=None):
+    #Generates speech with the streaming API and plays it while the rest is still being generated
+    #playback starts once preRoll seconds are buffered, save also writes the chunks to a WAV file as they arrive
+    #callback is called with each PCM chunk, returns the WAV path when saving
+    if not self.contents:
+      return None
+    bytesPerSecond = self.rate * self.channels * self.sampleWidth
+    preRollBytes = int(preRoll * bytesPerSecond)
+    engine = self.getAudioEngine() if play else None
+    #audio is held back until preRoll is reached so playback does not start and then stall
+    held = []
+    heldBytes = 0
+    writer = path = temp = None
+    if save:
+      path = self.getOutput().reservePath("out", ".wav")
+      temp = f"{path}.{threading.get_ident()}.tmp"
+      writer = wave.open(temp, "wb")
+      writer.setnchannels(self.channels)
+      writer.setsampwidth(self.sampleWidth)
+      writer.setframerate(self.rate)
+    pieces = []
+    converter = self.getConverter()
+    started = time.perf_counter()
+    self.firstAudioLatency = None
+    try:
+      stream = self.guarded(self.model, lambda: self.client.models.generate_content_stream(
+        model=self.model,
+        contents=self.contents,
+        config=self.configs
+      ), payload=self.contents)
+      for chunk in stream:
+        if not chunk.candidates or not chunk.candidates[0].content or not chunk.candidates[0].content.parts:
+          continue
+        for part in chunk.candidates[0].content.parts:
+          if part.inline_data is None or not part.inline_data.data:
+            continue
+          if self.firstAudioLatency is None:
+            self.firstAudioLatency = time.perf_counter() - started
+          data = converter.convert(part.inline_data.data)
+          if not data:
+            continue
+          pieces.append(data)
+          if writer:
+            writer.writeframes(data)
+          if callback:
+            callback(data)
+          if engine:
+            if held is None:
+              engine.write(data)
+              continue
+            held.append(data)
+            heldBytes += len(data)
+            if heldBytes >= preRollBytes:
+              engine.write(b"".join(held))
+              held = None
+    except Exception as e:
+      print(f"There was an error: {str(e)}")
+    finally:
+      if engine:
+        if held:
+          engine.write(b"".join(held))
+        engine.waitUntilDone()
+      if writer:
+        writer.close()
+        os.replace(temp, path)
+    self.pcm = b"".join(pieces)
+    return path
+
+  def getLongResponse(self, filename=None, maxChars=800, concurrency=4, crossfade=0.02):
+    #Long form synthesis, contents are split at sentence and speaker turn boundaries
+    #the chunks are synthesized concurrently, joined in order with a short crossfade and written once through wave_file
+    # i.e. myAI.singleSpeech.updateContents(chapter) then myAI.singleSpeech.getLongResponse("chapter1.wav")
+    if not self.contents:
+      return None
+    chunks = self.splitText(self.contents, maxChars)
+    if not chunks:
+      return None
+    try:
+      with concurrent.futures.ThreadPoolExecutor(min(concurrency, len(chunks))) as pool:
+        pieces = list(pool.map(self.synthesizeChunk, chunks))
+    except Exception as e:
+      print(f"There was an error: {str(e)}")
+      return None
+    self.pcm = self.convertPcm(self.assemblePcm(pieces, crossfade))
+    if filename is None:
+      filename = self.getOutput().reservePath("out", ".wav")
+    self.wave_file(filename)
+    return filename
+
+  def splitText(self, text, maxChars=800):
+    #Splits text into chunks of at most maxChars without breaking a sentence
+    #a speaker turn is only split between sentences and every part keeps its "Name: " prefix
+    #an instruction line before the first turn is repeated at the top of every chunk
+    header = ""
+    #the space left in a chunk once the header is added
+    budget = maxChars
+    pieces = []
+    prefix = ""
+    for line in text.splitlines():
+      line = line.strip()
+      if not line:
+        continue
+      body = line
+      if self.speakerTurns:
+        match = self.turnPattern.match(line)
+        if match and self.isSpeaker(match.group(1)):
+          prefix, body = f"{match.group(1)}: ", match.group(2)
+        elif not pieces and not header:
+          header = line
+          budget = max(1, maxChars - len(header) - 1)
+          continue
+      if len(prefix) + len(body) <= budget:
+        pieces.append(prefix + body)
+        continue
+      part = ""
+      for sentence in self.sentencePattern.split(body):
+        if part and len(prefix) + len(part) + len(sentence) + 1 > budget:
+          pieces.append(prefix + part)
+          part = ""
+        part = f"{part} {sentence}" if part else sentence
+      if part:
+        pieces.append(prefix + part)
+
+    chunks = []
+    current = []
+    size = 0
+    for piece in pieces:
+      if current and size + len(piece) + 1 > budget:
+        chunks.append("\n".join(current))
+        current = []
+        size = 0
+      current.append(piece)
+      size += len(piece) + 1
+    if current:
+      chunks.append("\n".join(current))
+    if header:
+      chunks = [f"{header}\n{chunk}" for chunk in chunks]
+    return chunks
+
+  def isSpeaker(self, name):
+    #overridden by MultiSpeech
+    return False
+
+  def synthesizeChunk(self, text):
+    #returns the PCM for one chunk, from the chunk cache when the text and voice are unchanged
+    key = self.chunkCache.makeKey(self.model, text, self.configs) if self.chunkCache else None
+    if key:
+      pcm = self.chunkCache.get(key)
+      if pcm is not None:
+        return pcm
+    response = self.guarded(self.model, lambda: self.client.models.generate_content(
+      model=self.model,
+      contents=text,
+      config=self.configs
+    ), payload=text)
+    pcm = b"".join(part.inline_data.data for part in response.candidates[0].content.parts if part.inline_data and part.inline_data.data)
+    if key:
+      self.chunkCache.put(key, pcm)
+    return pcm
+
+  def assemblePcm(self, pieces, crossfade=0.02):
+    #Joins the model's 16 bit PCM chunks into one preallocated buffer
+    #neighbouring chunks overlap by crossfade seconds with a linear fade so the joins are not audible
+    import numpy as np
+    frame = self.sourceChannels
+    arrays = [np.frombuffer(piece, dtype=np.int16, count=len(piece) // (2 * frame) * frame).reshape(-1, frame) for piece in pieces]
+    fade = int(crossfade * self.sourceRate)
+    overlaps = [min(fade, len(first), len(second)) for first, second in zip(arrays, arrays[1:])]
+    out = np.zeros((sum(len(array) for array in arrays) - sum(overlaps), frame), dtype=np.int16)
+    pos = 0
+    for index, array in enumerate(arrays):
+      overlap = overlaps[index - 1] if index else 0
+      if overlap:
+        ramp = np.linspace(0, 1, overlap, endpoint=False, dtype=np.float32)[:, None]
+        mixed = out[pos - overlap:pos] * (1 - ramp) + array[:overlap] * ramp
+        out[pos - overlap:pos] = mixed.astype(np.int16)
+        array = array[overlap:]
+      out[pos:pos + len(array)] = array
+      pos += len(array)
+    return out.tobytes()
+
+  def enableChunkCache(self, maxEntries=1024, diskPath=None, diskMaxBytes=1024 * 1024 * 1024):
+    #Caches long form chunks by text and voice so editing one paragraph only re-synthesizes that paragraph
+    # i.e. myAI.singleSpeech.enableChunkCache(diskPath="Output/speechCache")
+    self.chunkCache = responseCache(maxEntries, None, diskPath, diskMaxBytes)
+
+  def disableChunkCache(self):
+    self.chunkCache = None
+
+  def getChunkCacheStats(self):
+    #returns the chunk cache hit / miss counters
+    if self.chunkCache:
+      return self.chunkCache.getStats()
+
+  def getConverter(self):
+    #returns a converter from the model's PCM to the selected rate, channels and sample width
+    return pcmConverter(self.sourceRate, self.sourceChannels, self.sourceWidth, self.rate, self.channels, self.sampleWidth)
+
+  def convertPcm(self, pcm):
+    #converts a whole clip, streams use one converter from getConverter for every chunk
+    return self.getConverter().convert(pcm)
+
+  def getAudioEngine(self):
+    #returns this object's audio engine, shared by every speech object with the same format
+    #a new one is taken when the format changed or the engine was closed
+    engine = self.stream
+    if engine is None or engine.closed or engine.key != (self.rate, self.channels, self.sampleWidth):
+      engine = audioEngine.get(self.rate, self.channels, self.sampleWidth)
+      if self.stream is not None:
+        self.stream.release()
+      self.stream = engine
+    return engine
+
   def streamResponse(self):
-        self.stream = pyaudio.PyAudio().open(
-        format=pyaudio.paInt16,
-        channels=self.channels,
-        rate=self.rate,
-        output=True)
+        #opens (or reuses) the shared output device
+        self.getAudioEngine()
     
-  def playAudio(self):
+  def playAudio(self, wait=True):
         #getting it to work in the method declared by the docs proved unhelpful
+        #queues the audio behind anything already playing, wait=False returns straight away
         if self.response.candidates[0].content.parts[0].inline_data.data and self.stream:
-            self.stream.write(self.response.candidates[0].content.parts[0].inline_data.data)
+            self.stream.enqueue(self.convertPcm(self.response.candidates[0].content.parts[0].inline_data.data))
+            if wait:
+                self.stream.waitUntilDone()
+
+  def getAudioStats(self):
+    #returns underruns and buffer levels of the output device
+    if self.stream:
+      return self.stream.getStats()
+
+  def releaseAudio(self):
+    #releases this object's output device, it is closed once no other speech object uses it
+    if self.stream is not None:
+      self.stream.release()
+      self.stream = None
 
   def updateChannels(self, newChannels):
-    #Mono or stereo sound
+    #Mono or stereo sound, the model's mono audio is copied to both channels
     if  1 <= newChannels <= 2:
       self.channels = newChannels
-      self.updateConfigs()
 
   def updateRate(self, newRate):
-    #specifies the sample rate of the audio, measured in Hertz (Hz)
+    #specifies the sample rate of the audio, measured in Hertz (Hz), the model's audio is resampled to it
     if newRate in [8000, 16000, 24000, 44100, 48000]:
       self.rate = newRate
-      self.updateConfigs()
 
   def updateSampleWidth(self, newSampleWidth):
-    #Number of bits used to store sample
+    #Number of bytes used to store a sample
     if newSampleWidth in [1, 2, 3]:
       self.sampleWidth = newSampleWidth
-      self.updateConfigs()
 
   def getVoiceOptions(self):
     #returns supported voice names and vibe
@@ -587,9 +4075,9 @@ class speech(geminiAI):
 
 class singleSpeech(speech):
   # Experimental feature
-  def __init__(self, Key):
-    super().__init__(Key)
-    self.model = "gemini-2.5-flash-preview-tts",
+  def __init__(self, Key, client=None):
+    super().__init__(Key, client)
+    self.model = "gemini-2.5-flash-preview-tts"
     self.response = None
     self.contents = None
     self.voice = 'Kore'
@@ -600,11 +4088,21 @@ class singleSpeech(speech):
   def getResponse(self):
     #uses flash instead od pro
     if self.contents:
-      self.response = self.client.models.generate_content(
+      self.response = self.guarded(self.model, lambda: self.client.models.generate_content(
         model=self.model,
         contents=self.contents,
         config=self.configs
-      )
+      ), payload=self.contents)
+
+  async def getResponseAsync(self):
+    #Async version of getResponse
+    if self.contents:
+      self.response = await self.guardedAsync(self.model, lambda: self.client.aio.models.generate_content(
+        model=self.model,
+        contents=self.contents,
+        config=self.configs
+      ), payload=self.contents)
+      return self.response
 
   def updateVoice(self, newVoice):
     #changes the voice selected
@@ -642,9 +4140,11 @@ class singleSpeech(speech):
 
 class MultiSpeech(speech):
   # Experimental feature
-  def __init__(self, Key):
-    super().__init__(Key)
-    self.model = "gemini-2.5-flash-preview-tts",
+  speakerTurns = True
+
+  def __init__(self, Key, client=None):
+    super().__init__(Key, client)
+    self.model = "gemini-2.5-flash-preview-tts"
     self.response = None
     self.contents = None
     self.speakerNames = [None, None]
@@ -657,11 +4157,21 @@ class MultiSpeech(speech):
   def getResponse(self):
     #uses the flash version instead of the pro version
     if self.contents:
-      self.response = self.client.models.generate_content(
+      self.response = self.guarded(self.model, lambda: self.client.models.generate_content(
         model=self.model,
         contents=self.contents,
         config=self.configs
-      )
+      ), payload=self.contents)
+
+  async def getResponseAsync(self):
+    #Async version of getResponse
+    if self.contents:
+      self.response = await self.guardedAsync(self.model, lambda: self.client.aio.models.generate_content(
+        model=self.model,
+        contents=self.contents,
+        config=self.configs
+      ), payload=self.contents)
+      return self.response
   
   def updateConfigs(self):
     #Multi cast does not support languages or at minimum does not allow for the same method of integration
@@ -717,25 +4227,201 @@ class MultiSpeech(speech):
       if not self.contents:
         self.contents = f"{newPrompt}"
         return
-      self.contents = f"{self.contents}, {newPrompt}"
+      #each line is its own turn, joining with ", " merged separate turns together
+      self.contents = f"{self.contents}\n{newPrompt}"
 
   def clearContents(self):
     #clears prompt
     self.contents = None
 
+  def isSpeaker(self, name):
+    #any name counts as a speaker until the speaker names are set
+    names = [speaker for speaker in self.speakerNames if speaker]
+    return not names or name.strip() in names
+
+class musicPlayer():
+    #Plays Lyria audio from a bounded jitter buffer on the sounddevice callback thread
+    #The receive loop only pushes bytes, it never waits on the device
+    #Playback starts (and restarts after an underrun) once preRoll seconds are buffered
+    #When the buffer is full the oldest audio is dropped and counted as an overrun
+    def __init__(self, rate=48000, channels=2, bufferSeconds=4, preRoll=0.5):
+        self.rate = rate
+        self.channels = channels
+        self.bytesPerSecond = rate * channels * 2
+        self.ring = pcmRingBuffer(int(self.bytesPerSecond * bufferSeconds))
+        self.preRollBytes = int(self.bytesPerSecond * preRoll)
+        self.scratch = bytearray(self.ring.capacity)
+        self.playing = False
+        self.underruns = 0
+        self.overruns = 0
+        self.received = 0
+        self.stream = None
+
+    def start(self):
+        #opens the device, Lyria sends 16 bit PCM so the stream is int16 and bytes are copied straight in
+        import sounddevice as sd
+        self.stream = sd.RawOutputStream(samplerate=self.rate, channels=self.channels, dtype='int16', callback=self.callback)
+        self.stream.start()
+
+    def push(self, data):
+        #adds a chunk without blocking, dropping the oldest audio if there is no room
+        self.received += len(data)
+        data = memoryview(data)[-self.ring.capacity:]
+        excess = self.ring.available + len(data) - self.ring.capacity
+        if excess > 0:
+            #keeps whole frames so the channels stay aligned
+            frame = self.channels * 2
+            self.ring.readInto(memoryview(self.scratch)[:-(-excess // frame) * frame])
+            self.overruns += 1
+        self.ring.write(data, timeout=0)
+
+    def callback(self, outdata, frames, time, status):
+        out = memoryview(outdata).cast("B")
+        if not self.playing:
+            if self.ring.available < self.preRollBytes:
+                out[:] = bytes(len(out))
+                return
+            self.playing = True
+        count = self.ring.readInto(out)
+        if count < len(out):
+            out[count:] = bytes(len(out) - count)
+            self.underruns += 1
+            #waits for the pre roll again instead of stuttering
+            self.playing = False
+
+    def getStats(self):
+        #returns the jitter buffer counters
+        return {
+            "underruns": self.underruns,
+            "overruns": self.overruns,
+            "bufferSeconds": self.ring.available / self.bytesPerSecond,
+            "receivedSeconds": self.received / self.bytesPerSecond,
+            "playing": self.playing,
+        }
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.stop()
+            self.stream.close()
+            self.stream = None
+
+class musicCapture():
+    #Writes Lyria audio to disk as it arrives, for machines without an audio device
+    #Chunks go through a bounded queue to a background writer thread so memory stays fixed
+    #The capture is complete once seconds or maxBytes of audio have been received
+    def __init__(self, path, rate=48000, channels=2, format="wav", seconds=None, maxBytes=None, callback=None, sock=None, queueSize=64):
+        self.path = path
+        self.rate = rate
+        self.channels = channels
+        self.format = format
+        self.callback = callback
+        self.sock = sock
+        frame = channels * 2
+        self.bytesPerSecond = rate * frame
+        limits = [int(seconds * self.bytesPerSecond)] if seconds is not None else []
+        if maxBytes is not None:
+            limits.append(maxBytes)
+        #keeps whole frames so the last chunk does not split a sample
+        self.limit = min(limits) // frame * frame if limits else None
+        self.queue = queue.Queue(queueSize)
+        self.received = 0
+        self.written = 0
+        self.complete = False
+        self.error = None
+        self.file = None
+        self.thread = None
+
+    def start(self):
+        #opens the temp file and starts the writer thread
+        self.temp = f"{self.path}.{os.getpid()}.tmp"
+        if self.format == "flac":
+            import soundfile as sf
+            self.file = sf.SoundFile(self.temp, "w", samplerate=self.rate, channels=self.channels, subtype="PCM_16", format="FLAC")
+        else:
+            self.file = wave.open(self.temp, "wb")
+            self.file.setnchannels(self.channels)
+            self.file.setsampwidth(2)
+            self.file.setframerate(self.rate)
+        self.thread = threading.Thread(target=self.run, name="music-capture", daemon=True)
+        self.thread.start()
+
+    async def push(self, data):
+        #queues a chunk, waiting off the event loop when the writer falls behind
+        #returns True once the limit has been reached
+        if self.complete:
+            return True
+        if self.limit is not None:
+            data = data[:self.limit - self.received]
+            self.complete = self.received + len(data) >= self.limit
+        self.received += len(data)
+        try:
+            self.queue.put_nowait(data)
+        except queue.Full:
+            await asyncio.to_thread(self.queue.put, data)
+        return self.complete
+
+    def run(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                return
+            #after an error the queue is still drained so the receive loop never stalls
+            if self.error:
+                continue
+            try:
+                if self.format == "flac":
+                    self.file.buffer_write(data, dtype="int16")
+                else:
+                    self.file.writeframes(data)
+                if self.callback:
+                    self.callback(data)
+                if self.sock:
+                    self.sock.sendall(data)
+                self.written += len(data)
+            except Exception as e:
+                self.error = e
+
+    def close(self, keep=True):
+        #waits for the writer, finalises the header and moves the file into place
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+        if self.error or not keep:
+            os.remove(self.temp)
+            if self.error:
+                raise self.error
+            return None
+        os.replace(self.temp, self.path)
+        return self.path
+
+    def getStats(self):
+        return {
+            "receivedSeconds": self.received / self.bytesPerSecond,
+            "writtenSeconds": self.written / self.bytesPerSecond,
+            "queued": self.queue.qsize(),
+            "complete": self.complete,
+        }
+
 class music(geminiAI):
     #Experimental
 
     #God this sounds fucking terrible
     #please christ have mercy on my enternal soul for producing such a horrific sound
-    def __init__(self, Key):
-        self.client = genai.Client(api_key=Key, http_options={'api_version': 'v1alpha'})
+    def __init__(self, Key, client=None):
+        self.client = client or genai.Client(api_key=Key, http_options={'api_version': 'v1alpha'})
         self.model = 'models/lyria-realtime-exp'
-        self.rate = 24000
+        #Lyria streams 48 kHz stereo 16 bit PCM, it is converted when rate or channels differ
+        self.sourceRate = 48000
+        self.sourceChannels = 2
+        self.rate = 48000
         self.prompts = []
         self.contents = None
         self.config = None
-        self.channels = 1
+        self.channels = 2
+        self.stream = None
+        self.player = None
+        self.bufferSeconds = 4
+        self.preRoll = 0.5
         self.weight = 1.0
         self.guidance = 4.0
         self.bpm = 90
@@ -750,6 +4436,7 @@ class music(geminiAI):
         self.temperature = 1.1
         self.topK = 40
         self.seed = None
+        #the most recent session, used by play / pause / stop / reset
         self.session = None
         self.audioData = None
         self.updateConfig()
@@ -794,6 +4481,10 @@ class music(geminiAI):
             "Unsettling", "Upbeat", "Virtuoso", "Weird Noises"
         ]
 
+    def updateKey(self, key):
+        #Lyria realtime is only available on v1alpha
+        self.client = genai.Client(api_key=key, http_options={'api_version': 'v1alpha'})
+
     def getResponse(self):
         #Declares the stream, starts it and then requests the Live music
         self.updateStream()
@@ -801,55 +4492,136 @@ class music(geminiAI):
 
     def updateStream(self):
         #Declares stream and starts it
-        self.stream = sd.OutputStream(samplerate=self.rate, channels=self.channels, dtype='float32')
-        self.stream.start()
+        if self.player:
+            self.player.close()
+        self.player = musicPlayer(self.rate, self.channels, self.bufferSeconds, self.preRoll)
+        self.player.start()
+        self.stream = self.player.stream
 
     def updateChannels(self, newChannels):
         #Mono or stereo sound
         if  1 <= newChannels <= 2:
             self.channels = newChannels
-            self.updateStream()
+            if self.player:
+                self.updateStream()
 
     def updateRate(self, newRate):
         #specifies the sample rate of the audio, measured in Hertz (Hz)
         if newRate in [8000, 16000, 24000, 44100, 48000]:
             self.rate = newRate
-            self.updateStream()
+            if self.player:
+                self.updateStream()
+
+    def updateBuffering(self, bufferSeconds=4, preRoll=0.5):
+        #size of the jitter buffer and how much is buffered before playback starts
+        if 0 < preRoll < bufferSeconds:
+            self.bufferSeconds = bufferSeconds
+            self.preRoll = preRoll
+            if self.player:
+                self.updateStream()
 
-    async def genMusic(self):
+    def getAudioStats(self):
+        #returns underrun / overrun counters and the buffer level
+        if self.player:
+            return self.player.getStats()
+
+    def closeStream(self):
+        #stops playback and releases the device
+        if self.player:
+            self.player.close()
+        self.player = None
+        self.stream = None
+
+    def capture(self, path=None, seconds=None, maxBytes=None, format="wav", callback=None, sock=None):
+        #Renders the prompts straight to a WAV or FLAC file without opening an audio device
+        #each chunk can also be passed to callback and/or sent over sock as it is written
+        return asyncio.run(self.captureAsync(path, seconds, maxBytes, format, callback, sock))
+
+    async def captureAsync(self, path=None, seconds=None, maxBytes=None, format="wav", callback=None, sock=None):
+        #the session ends after seconds of audio or maxBytes of PCM, whichever comes first
+        #each capture runs its own session, so several can run at once on one music object
+        if seconds is None and maxBytes is None:
+            raise ValueError("capture needs seconds or maxBytes")
+        if path is None:
+            path = self.getOutput().reservePath("music", ".flac" if format == "flac" else ".wav")
+        recorder = musicCapture(path, self.rate, self.channels, format, seconds, maxBytes, callback, sock)
+        recorder.start()
+        try:
+            await self.genMusic(recorder)
+        except BaseException:
+            await asyncio.to_thread(recorder.close, False)
+            raise
+        return await asyncio.to_thread(recorder.close)
+
+    async def genMusic(self, recorder=None):
         #if prompt exists
+        #the session, converter and span belong to this call so concurrent sessions do not share them
         if self.prompts != []:
+            #one converter per session so resampling carries over between chunks
+            converter = pcmConverter(self.sourceRate, self.sourceChannels, 2, self.rate, self.channels, 2)
+            #the whole session is one call in the metrics, time to first byte is the first audio chunk
+            span = self.metrics.start(type(self).__name__, self.model, self.prompts) if self.metrics else None
+            #only the connection goes through the breaker and rate limit, the session itself is a stream
+            breaker = self.guard.getBreaker(self.model) if self.guard else None
+            allowed = trial = connected = False
+            try:
+                if breaker:
+                    #raises circuitOpenError while Lyria is failing
+                    trial = breaker.allow()
+                    allowed = True
+                    await asyncio.sleep(self.guard.limiter.reserve(self.model))
 
-            async with (
-                #creates the session
-                self.client.aio.live.music.connect(model=self.model) as self.session,
-                asyncio.TaskGroup() as tg,
-            ):
-                # Set up task to receive server messages.
-                audioTask = tg.create_task(self.recieveAudio())
-
-                # Send initial prompts and config
-                await self.session.set_weighted_prompts(
-                prompts=self.prompts
-                )
-                await self.session.set_music_generation_config(
-                config=self.config
-                )
-                #plays the session
-                await self.session.play()
+                if span:
+                    span.beginAttempt()
+                async with (
+                    #creates the session
+                    self.client.aio.live.music.connect(model=self.model) as session,
+                    asyncio.TaskGroup() as tg,
+                ):
+                    connected = True
+                    if breaker:
+                        breaker.recordSuccess()
+                    self.session = session
+                    # Set up task to receive server messages.
+                    audioTask = tg.create_task(self.recieveAudio(session, converter, span, recorder))
 
-    async def recieveAudio(self):
+                    # Send initial prompts and config
+                    await session.set_weighted_prompts(
+                    prompts=self.prompts
+                    )
+                    await session.set_music_generation_config(
+                    config=self.config
+                    )
+                    #plays the session
+                    await session.play()
+            except BaseException as e:
+                if allowed and not connected:
+                    #the same outcomes as requestGuard.call, a cancelled trial just frees the breaker
+                    if isinstance(e, Exception):
+                        breaker.recordFailure() if self.guard.isRetryable(e) else breaker.recordSuccess()
+                    elif trial:
+                        breaker.releaseTrial()
+                if span:
+                    span.fail(e)
+                raise
+            if span:
+                span.finish()
+
+    async def recieveAudio(self, session, converter, span=None, recorder=None):
        while True:
           #for each message in the session
-          async for message in self.session.receive():
+          async for message in session.receive():
             if message.server_content and message.server_content.audio_chunks:
-                self.audioData = message.server_content.audio_chunks[0].data
-                # Process audio
-                await asyncio.sleep(10**-12)
-
-                audio_data_np = np.frombuffer(self.audioData, dtype=np.float32)  
-                # Play  audio
-                self.stream.write(audio_data_np)
+                #every chunk goes into the jitter buffer, the device callback plays it
+                for chunk in message.server_content.audio_chunks:
+                    if span:
+                        span.observeBytes(len(chunk.data))
+                    self.audioData = converter.convert(chunk.data)
+                    if self.player:
+                        self.player.push(self.audioData)
+                    #ends the session once the capture has enough audio
+                    if recorder and await recorder.push(self.audioData):
+                        return
 
     def updateContents(self, newContents):
         #Updates prompt
@@ -1007,5 +4779,6 @@ class music(geminiAI):
         if self.session():
             self.session.reset_context()
         
-#Object Declaration
-myAI = geminiAI(api_key)
+if __name__ == "__main__":
+    #Object Declaration, only when run directly so importing has no side effects
+    myAI = geminiAI(api_key)
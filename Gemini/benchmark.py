@@ -0,0 +1,296 @@
+import argparse
+import concurrent.futures
+import contextlib
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+"""
+Benchmarks for the geminiAPI class, none of these call the Gemini API.
+
+The import benchmark imports GeminiAPI in a fresh interpreter.
+The offline suite runs every component against fakeGemini.fakeBackend, a local
+stand in for the API, and reports throughput, latency percentiles and peak memory.
+
+Run from the repository root:
+python Gemini/benchmark.py [import budget in seconds]
+python Gemini/benchmark.py --suite offline --runs 50 --latency 0.05 --error-rate 0.02
+python Gemini/benchmark.py --suite offline --save baseline.json
+python Gemini/benchmark.py --suite offline --baseline baseline.json --tolerance 0.25
+"""
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+#Modules that must never be loaded just by importing GeminiAPI
+#PIL is left out, google.genai's types module imports it whenever Pillow is installed
+heavyModules = ["numpy", "pyaudio", "sounddevice", "soundfile"]
+
+#google.genai is imported first so its own cost and the modules it loads are not blamed on GeminiAPI
+importSnippet = """
+import sys, time
+start = time.perf_counter()
+from google import genai
+middle = time.perf_counter()
+already = set(sys.modules)
+import GeminiAPI
+end = time.perf_counter()
+heavy = [name for name in {heavy!r} if name in sys.modules and name not in already]
+print(middle - start, end - middle, ",".join(heavy))
+"""
+
+def importTime(runs=10, budget=None):
+    #Imports GeminiAPI in a fresh interpreter each run and reports the median import time on top of google.genai
+    #budget (seconds) fails the benchmark when the median import is slower
+    times = []
+    genaiTimes = []
+    heavy = set()
+    env = dict(os.environ)
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, "-c", importSnippet.format(heavy=heavyModules)],
+            cwd=here, env=env, capture_output=True, text=True, check=True
+        )
+        fields = result.stdout.split()
+        genaiTimes.append(float(fields[0]))
+        times.append(float(fields[1]))
+        if len(fields) > 2:
+            heavy.update(fields[2].split(","))
+
+    median = statistics.median(times)
+    print(f"import google.genai: median {statistics.median(genaiTimes) * 1000:.1f} ms")
+    print(f"import GeminiAPI on top: median {median * 1000:.1f} ms, min {min(times) * 1000:.1f} ms over {runs} runs")
+    ok = True
+    if heavy:
+        print(f"heavy modules loaded at import: {', '.join(sorted(heavy))}")
+        ok = False
+    if budget is not None and median > budget:
+        print(f"import time over budget of {budget * 1000:.1f} ms")
+        ok = False
+    return ok
+
+def percentile(values, q):
+    #linear interpolation between the closest ranks
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+#Each scenario takes the geminiAI and returns something truthy when the run produced output
+#responses are cleared first so a failed run is not hidden by the previous response
+def textScenario(ai):
+    ai.text.response = None
+    ai.text.updateContents("Summarise the plot of Hamlet in three sentences.")
+    ai.text.AiResponse()
+    return ai.text.response and ai.text.response.text
+
+def textStreamScenario(ai):
+    ai.text.response = None
+    ai.text.updateContents("Write a short poem about the sea.")
+    ai.text.AiResponseStream()
+    return ai.text.response and ai.text.response.getText()
+
+def textBatchScenario(ai):
+    results = ai.text.AiResponseBatch([f"Give me fact number {n} about owls." for n in range(8)])
+    return results and all(result.ok for result in results)
+
+def imageScenario(ai):
+    ai.geminImage.response = None
+    ai.geminImage.clearContents()
+    ai.geminImage.updateContents("A lighthouse at dusk")
+    ai.geminImage.getResponse()
+    saves = ai.geminImage.saveImage()
+    return saves and all(save.result() for save in saves)
+
+def imagenScenario(ai):
+    ai.imagen3.response = None
+    ai.imagen3.updateContents("A red bicycle against a white wall")
+    ai.imagen3.generateImage()
+    paths = ai.imagen3.saveImage()
+    ai.flushOutput()
+    return paths
+
+def speechScenario(ai):
+    ai.singleSpeech.response = None
+    ai.singleSpeech.updateContents("Welcome to the benchmark.")
+    ai.singleSpeech.getResponse()
+    save = ai.singleSpeech.saveResponse()
+    return save and save.result()
+
+def speechStreamScenario(ai):
+    ai.singleSpeech.updateContents("Streaming speech straight to a file.")
+    return ai.singleSpeech.getResponseStream(play=False, save=True)
+
+def longSpeechScenario(ai):
+    ai.singleSpeech.updateContents("This is one sentence of a longer script. " * 60)
+    return ai.singleSpeech.getLongResponse(maxChars=400)
+
+def videoScenario(ai):
+    ai.veo3.operation = None
+    ai.veo3.updateContents("Waves rolling onto a beach")
+    manager = ai.veo3.getJobManager()
+    #the fake finishes after a few polls, so poll quickly to measure the loop rather than the wait
+    manager.minInterval = 0.01
+    manager.maxInterval = 0.05
+    ai.veo3.GenerateVideo()
+    return ai.veo3.saveVideo()
+
+def musicScenario(ai):
+    ai.lyria.clearPrompts()
+    ai.lyria.updateContents("Lo-Fi Hip Hop")
+    ai.lyria.addToPrompt()
+    return ai.lyria.capture(seconds=1)
+
+def outputScenario(ai):
+    #naming, sharding and atomic writes with no request at all
+    output = ai.getOutput()
+    saves = [output.saveBytes(b"x" * 4096, "bench", ".bin") for _ in range(100)]
+    return all(save.result() for save in saves)
+
+scenarios = {
+    "text": textScenario,
+    "text-stream": textStreamScenario,
+    "text-batch": textBatchScenario,
+    "image": imageScenario,
+    "imagen": imagenScenario,
+    "speech": speechScenario,
+    "speech-stream": speechStreamScenario,
+    "speech-long": longSpeechScenario,
+    "video": videoScenario,
+    "music": musicScenario,
+    "output": outputScenario,
+}
+
+def runScenario(name, scenario, ai, runs, concurrency=1, memoryRuns=3):
+    #times runs calls (concurrency at once) then measures peak memory over a few traced runs
+    #tracing is kept out of the timed runs as tracemalloc slows every allocation down
+    def timed():
+        start = time.perf_counter()
+        try:
+            ok = bool(scenario(ai))
+        except Exception as e:
+            print(f"There was an error: {str(e)}")
+            ok = False
+        return time.perf_counter() - start, ok
+
+    start = time.perf_counter()
+    if concurrency > 1:
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as pool:
+            samples = list(pool.map(lambda _: timed(), range(runs)))
+    else:
+        samples = [timed() for _ in range(runs)]
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    try:
+        for _ in range(memoryRuns):
+            timed()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    times = [sample for sample, _ in samples]
+    return {
+        "scenario": name,
+        "runs": runs,
+        "failed": sum(1 for _, ok in samples if not ok),
+        "throughput": runs / elapsed,
+        "p50": percentile(times, 0.5),
+        "p95": percentile(times, 0.95),
+        "p99": percentile(times, 0.99),
+        "max": max(times),
+        "peakMemory": peak,
+    }
+
+def printResult(result):
+    print(
+        f"{result['scenario']:<14} {result['throughput']:>9.1f}/s"
+        f"  p50 {result['p50'] * 1000:>8.2f} ms  p95 {result['p95'] * 1000:>8.2f} ms  p99 {result['p99'] * 1000:>8.2f} ms"
+        f"  peak {result['peakMemory'] / 1024 / 1024:>7.2f} MiB  failed {result['failed']}/{result['runs']}"
+    )
+
+def offlineSuite(names=None, runs=20, concurrency=1, **backendOptions):
+    #Runs each scenario against a fresh fake backend inside a temp folder, returns the results
+    sys.path.insert(0, here)
+    import GeminiAPI
+    import fakeGemini
+
+    results = []
+    previous = os.getcwd()
+    with tempfile.TemporaryDirectory() as folder:
+        os.chdir(folder)
+        try:
+            for name in names or scenarios:
+                backend = fakeGemini.fakeBackend(**backendOptions)
+                ai = GeminiAPI.geminiAI("fake", httpOptions=backend.httpOptions())
+                backend.attachMusic(ai.getMusicClient())
+                #the guard retries injected errors, keep its backoff short so runs measure the library
+                ai.guard.baseDelay = 0.01
+                ai.guard.maxDelay = 0.1
+                with contextlib.redirect_stdout(sys.stderr):
+                    result = runScenario(name, scenarios[name], ai, runs, concurrency)
+                ai.flushOutput()
+                result["injected"] = backend.getStats()["injected"]
+                printResult(result)
+                results.append(result)
+        finally:
+            os.chdir(previous)
+    return results
+
+def compareToBaseline(results, path, tolerance):
+    #fails when a scenario's median is more than tolerance slower than the saved baseline
+    with open(path) as f:
+        baseline = {result["scenario"]: result for result in json.load(f)}
+    ok = True
+    for result in results:
+        before = baseline.get(result["scenario"])
+        if not before or not before["p50"]:
+            continue
+        change = result["p50"] / before["p50"] - 1
+        if change > tolerance:
+            print(f"{result['scenario']}: p50 {change * 100:.0f}% slower than the baseline")
+            ok = False
+        if result["failed"] > before["failed"]:
+            print(f"{result['scenario']}: {result['failed']} failed runs, the baseline had {before['failed']}")
+            ok = False
+    return ok
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="GeminiAPI benchmarks, no requests reach the Gemini API")
+    parser.add_argument("budget", nargs="?", type=float, help="import time budget in seconds")
+    parser.add_argument("--suite", choices=["import", "offline", "all"], default="all")
+    parser.add_argument("--scenarios", help=f"comma separated subset of {', '.join(scenarios)}")
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds the fake backend waits before answering")
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--chunk-interval", type=float, default=0.0, help="seconds between streamed chunks")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests that fail with a 503")
+    parser.add_argument("--save", help="write the offline results to this JSON file")
+    parser.add_argument("--baseline", help="compare the offline results to a saved JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    ok = True
+    if args.suite in ("import", "all"):
+        ok = importTime(budget=args.budget) and ok
+    if args.suite in ("offline", "all"):
+        names = args.scenarios.split(",") if args.scenarios else None
+        results = offlineSuite(
+            names, args.runs, args.concurrency,
+            latency=args.latency, jitter=args.jitter, chunkInterval=args.chunk_interval, errorRate=args.error_rate
+        )
+        if args.save:
+            with open(args.save, "w") as f:
+                json.dump(results, f, indent=2)
+        if args.baseline:
+            ok = compareToBaseline(results, args.baseline, args.tolerance) and ok
+    if not ok:
+        sys.exit(1)
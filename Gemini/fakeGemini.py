@@ -0,0 +1,298 @@
+import asyncio
+import base64
+import contextlib
+import itertools
+import json
+import math
+import random
+import struct
+import threading
+import time
+import zlib
+
+import httpx
+from google import genai
+from google.genai import types
+
+"""
+A local stand in for the Gemini API, used by benchmark.py.
+
+HTTP requests are answered by an httpx transport passed through http_options, so the
+real google-genai client still builds, sends and parses every request.
+Lyria's websocket is replaced by an in process session on the music client.
+
+backend = fakeBackend(latency=0.05, errorRate=0.01)
+myAI = geminiAI("fake", httpOptions=backend.httpOptions())
+backend.attachMusic(myAI.getMusicClient())
+"""
+
+def makePcm(rate, channels, seconds, frequency=440):
+    #16 bit sine wave, the same format the TTS and Lyria models return
+    samples = []
+    for n in range(int(rate * seconds)):
+        value = int(12000 * math.sin(2 * math.pi * frequency * n / rate))
+        samples.extend([value] * channels)
+    return struct.pack(f"<{len(samples)}h", *samples)
+
+def makePng(size):
+    #a gradient PNG built without PIL so the backend has no image dependency
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+    rows = b"".join(
+        b"\x00" + b"".join(bytes((x * 255 // size, y * 255 // size, 128)) for x in range(size))
+        for y in range(size)
+    )
+    header = struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(rows)) + chunk(b"IEND", b"")
+
+class fakeBackend():
+    #Canned responses for every endpoint GeminiAPI uses, with configurable latency and injected errors
+    #latency (plus up to jitter) is added before every response, streams also wait chunkInterval between chunks
+    #errorRate is the chance a request fails with errorCode, the guard retries it like a real outage
+    #videos are done after videoPolls operation polls
+    def __init__(self, latency=0.0, jitter=0.0, errorRate=0.0, errorCode=503, streamChunks=8, chunkInterval=0.0,
+                 textBytes=512, pcmSeconds=2.0, imageSize=256, videoBytes=1024 * 1024, videoPolls=2, musicChunkSeconds=0.1, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.errorRate = errorRate
+        self.errorCode = errorCode
+        self.streamChunks = streamChunks
+        self.chunkInterval = chunkInterval
+        self.videoPolls = videoPolls
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.text = ("The quick brown fox jumps over the lazy dog. " * (textBytes // 45 + 1))[:textBytes]
+        self.pcm = makePcm(24000, 1, pcmSeconds)
+        self.musicChunk = makePcm(48000, 2, musicChunkSeconds)
+        self.image = makePng(imageSize)
+        self.video = self.random.randbytes(videoBytes)
+        self.operations = {}
+        self.counter = itertools.count()
+        self.requests = {}
+        self.injected = 0
+
+    def httpOptions(self, apiVersion=None):
+        #http_options for genai.Client or geminiAI(httpOptions=...)
+        options = {
+            "client_args": {"transport": fakeTransport(self)},
+            "async_client_args": {"transport": fakeAsyncTransport(self)},
+        }
+        if apiVersion:
+            options["api_version"] = apiVersion
+        return options
+
+    def client(self, apiVersion=None):
+        #returns a genai.Client that only talks to this backend
+        client = genai.Client(api_key="fake", http_options=self.httpOptions(apiVersion))
+        self.attachMusic(client)
+        return client
+
+    def attachMusic(self, client):
+        #swaps the Lyria websocket for an in process session
+        client.aio.live.music.connect = self.connectMusic
+        return client
+
+    def delay(self):
+        with self.lock:
+            return self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+
+    def shouldFail(self):
+        if not self.errorRate:
+            return False
+        with self.lock:
+            failed = self.random.random() < self.errorRate
+            if failed:
+                self.injected += 1
+            return failed
+
+    def count(self, route):
+        with self.lock:
+            self.requests[route] = self.requests.get(route, 0) + 1
+
+    def getStats(self):
+        #requests per route and how many errors were injected
+        with self.lock:
+            return {"requests": dict(self.requests), "injected": self.injected}
+
+    def respond(self, request):
+        #returns (status, headers, body), body is a list of chunks for streamed responses
+        path = request.url.path
+        route = path.rsplit(":", 1)[-1] if ":" in path else path.rsplit("/", 2)[-2]
+        self.count(route)
+        if self.shouldFail():
+            error = {"error": {"code": self.errorCode, "message": "Injected by fakeBackend", "status": "UNAVAILABLE"}}
+            return self.errorCode, {"content-type": "application/json"}, json.dumps(error).encode()
+        body = json.loads(request.content) if request.content else {}
+        if path.endswith(":generateContent"):
+            return self.json(self.generateContent(body))
+        if path.endswith(":streamGenerateContent"):
+            events = [f"data: {json.dumps(chunk)}\r\n\r\n".encode() for chunk in self.streamContent(body)]
+            return 200, {"content-type": "text/event-stream"}, events
+        if path.endswith(":countTokens"):
+            return self.json({"totalTokens": len(request.content) // 4 + 1})
+        if path.endswith(":predict"):
+            return self.json(self.predict(body))
+        if path.endswith(":predictLongRunning"):
+            name = f"{path.split('/v1beta/')[-1].rsplit(':', 1)[0]}/operations/fake{next(self.counter)}"
+            with self.lock:
+                self.operations[name] = self.videoPolls
+            return self.json({"name": name})
+        if "/operations/" in path:
+            return self.json(self.pollOperation(path.split("/v1beta/")[-1].split("/v1alpha/")[-1]))
+        if path.endswith(":download"):
+            return 200, {"content-type": "video/mp4"}, self.video
+        return 404, {"content-type": "application/json"}, json.dumps({"error": {"code": 404, "message": f"{path} is not faked", "status": "NOT_FOUND"}}).encode()
+
+    def json(self, value):
+        return 200, {"content-type": "application/json"}, json.dumps(value).encode()
+
+    def usage(self, outputTokens):
+        return {"promptTokenCount": 16, "candidatesTokenCount": outputTokens, "totalTokenCount": 16 + outputTokens}
+
+    def modalities(self, body):
+        return body.get("generationConfig", {}).get("responseModalities") or ["TEXT"]
+
+    def generateContent(self, body):
+        modalities = self.modalities(body)
+        parts = []
+        if "AUDIO" in modalities:
+            parts.append({"inlineData": {"mimeType": "audio/L16;codec=pcm;rate=24000", "data": base64.b64encode(self.pcm).decode()}})
+        else:
+            parts.append({"text": self.text})
+            if "IMAGE" in modalities:
+                parts.append({"inlineData": {"mimeType": "image/png", "data": base64.b64encode(self.image).decode()}})
+        return {
+            "candidates": [{"content": {"role": "model", "parts": parts}, "finishReason": "STOP"}],
+            "usageMetadata": self.usage(len(self.text) // 4),
+        }
+
+    def streamContent(self, body):
+        #splits the canned text or audio into streamChunks pieces
+        audio = "AUDIO" in self.modalities(body)
+        data = self.pcm if audio else self.text
+        size = -(-len(data) // self.streamChunks)
+        if audio:
+            size += size % 2
+        pieces = [data[start:start + size] for start in range(0, len(data), size)]
+        chunks = []
+        for index, piece in enumerate(pieces):
+            if audio:
+                part = {"inlineData": {"mimeType": "audio/L16;codec=pcm;rate=24000", "data": base64.b64encode(piece).decode()}}
+            else:
+                part = {"text": piece}
+            chunk = {"candidates": [{"content": {"role": "model", "parts": [part]}}]}
+            if index == len(pieces) - 1:
+                chunk["candidates"][0]["finishReason"] = "STOP"
+                chunk["usageMetadata"] = self.usage(len(self.text) // 4)
+            chunks.append(chunk)
+        return chunks
+
+    def predict(self, body):
+        count = body.get("parameters", {}).get("sampleCount") or 1
+        image = base64.b64encode(self.image).decode()
+        return {"predictions": [{"bytesBase64Encoded": image, "mimeType": "image/png"} for _ in range(count)]}
+
+    def pollOperation(self, name):
+        with self.lock:
+            remaining = self.operations.get(name, 0)
+            self.operations[name] = remaining - 1
+        if remaining > 0:
+            return {"name": name, "done": False}
+        uri = f"https://generativelanguage.googleapis.com/v1beta/files/{name.rsplit('/', 1)[-1]}:download?alt=media"
+        return {
+            "name": name,
+            "done": True,
+            "response": {"generateVideoResponse": {"generatedSamples": [{"video": {"uri": uri}}]}},
+        }
+
+    @contextlib.asynccontextmanager
+    async def connectMusic(self, model):
+        #in process replacement for client.aio.live.music.connect
+        self.count("music")
+        await asyncio.sleep(self.delay())
+        if self.shouldFail():
+            raise ConnectionError("Injected by fakeBackend")
+        yield fakeMusicSession(self)
+
+class fakeTransport(httpx.BaseTransport):
+    def __init__(self, backend):
+        self.backend = backend
+
+    def handle_request(self, request):
+        request.read()
+        delay = self.backend.delay()
+        if delay:
+            time.sleep(delay)
+        status, headers, body = self.backend.respond(request)
+        if isinstance(body, list):
+            return httpx.Response(status, headers=headers, stream=pacedStream(body, self.backend.chunkInterval))
+        return httpx.Response(status, headers=headers, content=body)
+
+class fakeAsyncTransport(httpx.AsyncBaseTransport):
+    def __init__(self, backend):
+        self.backend = backend
+
+    async def handle_async_request(self, request):
+        await request.aread()
+        delay = self.backend.delay()
+        if delay:
+            await asyncio.sleep(delay)
+        status, headers, body = self.backend.respond(request)
+        if isinstance(body, list):
+            return httpx.Response(status, headers=headers, stream=pacedStreamAsync(body, self.backend.chunkInterval))
+        return httpx.Response(status, headers=headers, content=body)
+
+class pacedStream(httpx.SyncByteStream):
+    #yields the chunks of a streamed response interval seconds apart
+    def __init__(self, chunks, interval):
+        self.chunks = chunks
+        self.interval = interval
+
+    def __iter__(self):
+        for index, chunk in enumerate(self.chunks):
+            if index and self.interval:
+                time.sleep(self.interval)
+            yield chunk
+
+class pacedStreamAsync(httpx.AsyncByteStream):
+    def __init__(self, chunks, interval):
+        self.chunks = chunks
+        self.interval = interval
+
+    async def __aiter__(self):
+        for index, chunk in enumerate(self.chunks):
+            if index and self.interval:
+                await asyncio.sleep(self.interval)
+            yield chunk
+
+class fakeMusicSession():
+    #Streams the canned 48 kHz stereo chunk until the caller leaves the session
+    def __init__(self, backend):
+        self.backend = backend
+        self.playing = asyncio.Event()
+
+    async def set_weighted_prompts(self, prompts):
+        pass
+
+    async def set_music_generation_config(self, config):
+        pass
+
+    async def play(self):
+        self.playing.set()
+
+    async def pause(self):
+        self.playing.clear()
+
+    async def stop(self):
+        self.playing.clear()
+
+    async def reset_context(self):
+        pass
+
+    async def receive(self):
+        chunk = types.AudioChunk(data=self.backend.musicChunk, mime_type="audio/l16;rate=48000;channels=2")
+        while True:
+            await self.playing.wait()
+            #always yields to the event loop, even when chunkInterval is 0
+            await asyncio.sleep(self.backend.chunkInterval)
+            yield types.LiveMusicServerMessage(server_content=types.LiveMusicServerContent(audio_chunks=[chunk]))